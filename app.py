@@ -1,18 +1,38 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, g, has_request_context, session
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_socketio import SocketIO, emit
 from flask_mail import Mail, Message
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta, timezone
-import os, random, string, json
+from datetime import datetime, timedelta, timezone, time as dtime
+from zoneinfo import ZoneInfo
+from collections import OrderedDict
+from bisect import bisect_left
+from functools import wraps
+import os, io, re, csv, gzip, math, base64, random, string, json, threading, time, hashlib, uuid
 try:
     from detect import detect_crowd, get_crowd_status
 except ImportError:
     def detect_crowd(source): return 0
     def get_crowd_status(count): return 'Low'
-from sqlalchemy import text
+try:
+    import segno
+except ImportError:
+    segno = None
+try:
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    Ed25519PrivateKey = None
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import text, insert, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import joinedload, selectinload, object_session, Session
+import click
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
@@ -60,6 +80,12 @@ class Booking(db.Model):
     total_amount = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     temple = db.relationship('Temple', backref='bookings')
+    __table_args__ = (
+        db.Index('idx_booking_created', 'created_at'),
+        db.Index('idx_booking_payment_created', 'payment_status', 'created_at'),
+        db.Index('idx_booking_temple_created', 'temple_id', 'created_at'),
+        db.Index('idx_booking_user_created', 'user_id', 'created_at'),
+    )
 
 class Crowd(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -93,8 +119,14 @@ class Order(db.Model):
     total_amount = db.Column(db.Float, nullable=False)
     qr_code = db.Column(db.String(100), unique=True, nullable=False)
     status = db.Column(db.String(20), default='pending')  # pending, collected
+    collected_at = db.Column(db.DateTime)
+    collected_batch = db.Column(db.String(32))  # identifies the request that collected the order
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     booking = db.relationship('Booking', backref='orders')
+    __table_args__ = (
+        db.Index('idx_order_created', 'created_at'),
+        db.Index('idx_order_status', 'status'),
+    )
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -103,19 +135,797 @@ class OrderItem(db.Model):
     item_id = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, default=1)
     price = db.Column(db.Float, nullable=False)
+    # Snapshot of the catalog item at purchase time
+    name = db.Column(db.String(100))
+    unit_price = db.Column(db.Float)
+    duration = db.Column(db.Integer)
     order = db.relationship('Order', backref='items')
 
+class DailyTempleStats(db.Model):
+    """Per-day, per-temple booking rollup keyed by the booking's local creation day"""
+    __tablename__ = 'daily_temple_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    temple_id = db.Column(db.Integer, db.ForeignKey('temple.id'), nullable=False)
+    bookings = db.Column(db.Integer, nullable=False, default=0)  # all bookings created
+    paid_bookings = db.Column(db.Integer, nullable=False, default=0)
+    visitors = db.Column(db.Integer, nullable=False, default=0)  # persons on paid bookings
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    prasad_revenue = db.Column(db.Float, nullable=False, default=0)
+    pooja_revenue = db.Column(db.Float, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('day', 'temple_id', name='uq_daily_temple_stats_day_temple'),)
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False, default='plain')  # plain, booking_confirmation, crowd_alert
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(200))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    claim_token = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (db.Index('idx_outbox_status_next', 'status', 'next_attempt_at'),)
+
+class CrowdAlert(db.Model):
+    """When each temple's last high-crowd alert went out, shared by all processes for throttling"""
+    __tablename__ = 'crowd_alert'
+    temple_id = db.Column(db.Integer, db.ForeignKey('temple.id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+    last_sent_at = db.Column(db.DateTime, nullable=False)
+
+class UserChange(db.Model):
+    """Users edited or deleted recently, so every process can drop its cached copy"""
+    __tablename__ = 'user_change'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class IdempotencyKey(db.Model):
+    """Idempotency-Key claimed by a request; 'pending' while it runs, then holds the response"""
+    __tablename__ = 'idempotency_key'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    request_key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    state = db.Column(db.String(10), nullable=False, default='pending')  # pending, done
+    status_code = db.Column(db.Integer)
+    mimetype = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary(length=2 ** 24))
+    created_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'endpoint', 'request_key', name='uq_idempotency_user_endpoint_key'),
+        db.Index('idx_idempotency_created', 'created_at'),
+    )
+
+class CatalogChange(db.Model):
+    """One row per temple catalog change; the highest id is the catalog version every process serves"""
+    __tablename__ = 'catalog_change'
+    id = db.Column(db.Integer, primary_key=True)
+    temple_id = db.Column(db.Integer)  # None means everything changed
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+class IdWorkerLease(db.Model):
+    """Which running process owns each IdGenerator worker id"""
+    __tablename__ = 'id_worker_lease'
+    worker_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    holder = db.Column(db.String(32), nullable=False)
+    renewed_at = db.Column(db.DateTime, nullable=False)
+
+class SessionUser(UserMixin):
+    """Plain snapshot of a User for current_user; never attached to a DB session"""
+    
+    def __init__(self, user):
+        self.id = user.id
+        self.name = user.name
+        self.email = user.email
+        self.role = user.role
+
+class UserCache:
+    """Bounded user_id -> SessionUser map with TTL, so most requests skip the user lookup.
+    Edits made by other processes arrive through user_change, read every USER_SYNC_SECONDS"""
+    
+    # Re-read this far back each sync, for transactions that commit after a later one
+    SYNC_OVERLAP = 30
+    # user_change rows are only needed until every process has synced past them
+    CHANGE_RETENTION = 3600
+    
+    def __init__(self, ttl, max_users):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._synced = 0.0
+        self._synced_at = None
+        self._pruned = 0.0
+        self._sync_lock = threading.Lock()
+    
+    def sync(self):
+        """Drop users changed by any process since the last check"""
+        if time.monotonic() - self._synced < app.config['USER_SYNC_SECONDS']:
+            return
+        with self._sync_lock:
+            if time.monotonic() - self._synced < app.config['USER_SYNC_SECONDS']:
+                return
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            since = (self._synced_at or now) - timedelta(seconds=self.SYNC_OVERLAP)
+            changed = db.session.query(UserChange.user_id).filter(UserChange.changed_at >= since).distinct().all()
+            for (user_id,) in changed:
+                self.invalidate(user_id)
+            if time.monotonic() - self._pruned > self.CHANGE_RETENTION / 4:
+                UserChange.query.filter(
+                    UserChange.changed_at < now - timedelta(seconds=self.CHANGE_RETENTION)
+                ).delete(synchronize_session=False)
+                db.session.commit()
+                self._pruned = time.monotonic()
+            self._synced_at = now
+            self._synced = time.monotonic()
+    
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+            generation = self._generation
+        
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        snapshot = SessionUser(user)
+        with self._lock:
+            # A profile change committed while we were loading wins over our copy
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, snapshot)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return snapshot
+    
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+user_cache = UserCache(app.config['USER_CACHE_TTL'], app.config['USER_CACHE_SIZE'])
+
+# Role/profile edits drop the cached copy once they are committed: here at once, in other
+# processes through the user_change row written in the same transaction
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def mark_user_stale(mapper, connection, target):
+    object_session(target).info.setdefault('stale_users', set()).add(target.id)
+    connection.execute(UserChange.__table__.insert().values(
+        user_id=target.id, changed_at=datetime.now(timezone.utc).replace(tzinfo=None)
+    ))
+
+@event.listens_for(Session, 'after_commit')
+def drop_stale_users(session):
+    for user_id in session.info.pop('stale_users', ()):
+        user_cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_stale_users(session):
+    session.info.pop('stale_users', None)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """Caps how many password hashes run at once, so a burst of logins or registrations can't
+    take every CPU. Hashes run on the request thread: `workers` at a time, up to `backlog` more
+    wait at most `timeout` seconds for a turn and anything beyond that is turned away at once"""
+    
+    def __init__(self, workers, backlog, timeout):
+        self.timeout = timeout
+        self._running = threading.BoundedSemaphore(workers)
+        self._admitted = threading.BoundedSemaphore(workers + backlog)
+        self._dummy_hash = None
+    
+    def _run(self, fn, *args):
+        if not self._admitted.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            if not self._running.acquire(timeout=self.timeout):
+                raise HasherBusy()
+            try:
+                return fn(*args)
+            finally:
+                self._running.release()
+        finally:
+            self._admitted.release()
+    
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+    
+    def verify(self, password_hash, password):
+        """Check password against a stored hash. Without one (unknown account) it is checked
+        against a dummy hash and fails, taking as long as a real account would"""
+        if password_hash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash(uuid.uuid4().hex)
+            self._run(check_password_hash, self._dummy_hash, password)
+            return False
+        return self._run(check_password_hash, password_hash, password)
+    
+    def needs_rehash(self, password_hash):
+        """True when a stored hash was made with a different method or cost than configured"""
+        return password_hash.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_BACKLOG'],
+                                 app.config['PASSWORD_HASH_TIMEOUT'])
+
+class TokenBucketLimiter:
+    """Per-key token buckets: `burst` attempts at once, refilled at `per_minute`.
+    Least recently seen keys are dropped beyond max_keys. Buckets live in this process,
+    so with N app processes a client can get up to N times the configured rate"""
+    
+    def __init__(self, per_minute, burst, max_keys=100000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+auth_ip_limiter = TokenBucketLimiter(app.config['AUTH_RATE_PER_IP'], app.config['AUTH_BURST_PER_IP'])
+auth_account_limiter = TokenBucketLimiter(app.config['AUTH_RATE_PER_ACCOUNT'], app.config['AUTH_BURST_PER_ACCOUNT'])
+
+def auth_rate_limited(email):
+    """Charge one auth attempt to the client IP and the account; True if either is out of tokens"""
+    ip_ok = auth_ip_limiter.allow(request.remote_addr or '-')
+    account_ok = auth_account_limiter.allow((email or '').strip().lower())
+    return not (ip_ok and account_ok)
+
+ID_ALPHABET = string.digits + string.ascii_uppercase
+
+def _check_char(body):
+    """Luhn mod 36 check character, catches single typos and adjacent swaps"""
+    factor = 2
+    total = 0
+    for char in reversed(body):
+        addend = factor * ID_ALPHABET.index(char)
+        factor = 1 if factor == 2 else 2
+        total += addend // 36 + addend % 36
+    return ID_ALPHABET[(36 - total % 36) % 36]
+
+class IdGenerator:
+    """Snowflake-style ids: 41 bits of milliseconds, 10 bits of worker id, 12 bits of sequence.
+    Ids are unique per worker without asking the database and sort by creation time"""
+    
+    EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+    WIDTH = 13  # base36 digits needed for 63 bits
+    
+    def __init__(self, worker_id=None, lease=None):
+        if worker_id is None and lease is None:
+            raise ValueError('either worker_id or lease is required')
+        if worker_id is not None and not 0 <= worker_id < 1024:
+            raise ValueError('worker_id must be between 0 and 1023')
+        self.worker_id = worker_id
+        self.lease = lease
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+    
+    def next_id(self):
+        with self._lock:
+            if self.lease is not None:
+                self.worker_id = self.lease.current()
+            now = int(time.time() * 1000) - self.EPOCH_MS
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                # Same millisecond or clock moved back: keep counting from the last timestamp
+                self._sequence = (self._sequence + 1) & 0xFFF
+                if self._sequence == 0:
+                    self._last += 1
+            return (self._last << 22) | (self.worker_id << 12) | self._sequence
+    
+    def next_code(self, prefix):
+        number = self.next_id()
+        digits = []
+        for _ in range(self.WIDTH):
+            number, digit = divmod(number, 36)
+            digits.append(ID_ALPHABET[digit])
+        body = ''.join(reversed(digits))
+        return prefix + body + _check_char(body)
+
+class WorkerIdLease:
+    """Leases a free worker id from id_worker_lease so processes never share one.
+    The lease is renewed before use once it is RENEW_SECONDS old; a lease left
+    unrenewed for EXPIRE_SECONDS belongs to a dead process and may be taken over"""
+    
+    RENEW_SECONDS = 60
+    EXPIRE_SECONDS = 600
+    
+    def __init__(self):
+        self.holder = uuid.uuid4().hex
+        self.worker_id = None
+        self._renewed = 0.0
+    
+    def current(self):
+        """Worker id owned by this process; called under the IdGenerator lock"""
+        now = time.monotonic()
+        if self.worker_id is None or now - self._renewed >= self.RENEW_SECONDS:
+            if self.worker_id is None or not self._renew():
+                self.worker_id = self._acquire()
+            self._renewed = now
+        return self.worker_id
+    
+    def _renew(self):
+        table = IdWorkerLease.__table__
+        with db.engine.begin() as conn:
+            result = conn.execute(table.update()
+                                  .where(table.c.worker_id == self.worker_id, table.c.holder == self.holder)
+                                  .values(renewed_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+        return result.rowcount == 1
+    
+    def _acquire(self):
+        table = IdWorkerLease.__table__
+        for _ in range(10):
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            stale = now - timedelta(seconds=self.EXPIRE_SECONDS)
+            with db.engine.begin() as conn:
+                rows = conn.execute(db.select(table.c.worker_id, table.c.renewed_at)).all()
+                # Take over a dead process's id first, then any id never leased
+                for worker_id, renewed_at in rows:
+                    if renewed_at < stale:
+                        taken = conn.execute(table.update()
+                                             .where(table.c.worker_id == worker_id, table.c.renewed_at < stale)
+                                             .values(holder=self.holder, renewed_at=now))
+                        if taken.rowcount == 1:
+                            return worker_id
+                free = sorted(set(range(1024)) - {worker_id for worker_id, _ in rows})
+            if not free:
+                raise RuntimeError('All 1024 id worker ids are leased; set ID_WORKER_ID explicitly')
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert().values(worker_id=random.choice(free), holder=self.holder, renewed_at=now))
+                    return conn.execute(db.select(table.c.worker_id).where(table.c.holder == self.holder)).scalar()
+            except IntegrityError:
+                continue  # another process inserted the same id first
+        raise RuntimeError('Could not lease an id worker id')
+
+if app.config['ID_WORKER_ID']:
+    id_generator = IdGenerator(int(app.config['ID_WORKER_ID']))
+else:
+    id_generator = IdGenerator(lease=WorkerIdLease())
+
+def has_valid_check_char(code, prefix):
+    """True if code is a well-formed generated id. Legacy random ids have no check character"""
+    body = code[len(prefix):]
+    if not code.startswith(prefix) or len(body) != IdGenerator.WIDTH + 1:
+        return False
+    if any(char not in ID_ALPHABET for char in body):
+        return False
+    return _check_char(body[:-1]) == body[-1]
 
 def generate_confirmation_id():
     """Generate unique confirmation ID"""
-    return 'TMP' + ''.join(random.choices(string.digits, k=8))
+    return id_generator.next_code('TMP')
 
 def generate_qr_code():
     """Generate unique QR code for orders"""
-    return 'QR' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+    return id_generator.next_code('QR')
+
+# In-process prasad/pooja catalog, one entry per temple.
+# Entries are plain dicts so they can outlive the request session.
+_catalog_cache = {}
+_catalog_generation = 0
+_catalog_lock = threading.Lock()
+
+def _catalog_entry(item):
+    return {
+        'id': item.id,
+        'name': item.name,
+        'price': item.price,
+        'duration': getattr(item, 'duration', None),
+        'temple_id': item.temple_id,
+        'is_available': bool(item.is_available)
+    }
+
+def load_temple_catalogs(temple_ids):
+    """Return {temple_id: catalog} for several temples, loading the uncached ones with one query per item type"""
+    temple_ids = set(temple_ids)
+    catalogs = {t: _catalog_cache[t] for t in temple_ids if t in _catalog_cache}
+    missing = temple_ids - set(catalogs)
+    if not missing:
+        return catalogs
+    
+    generation = _catalog_generation
+    loaded = {t: {'prasad': {}, 'pooja': {}} for t in missing}
+    for item_type, model in (('prasad', Prasad), ('pooja', Pooja)):
+        for item in model.query.filter(model.temple_id.in_(missing)).all():
+            loaded[item.temple_id][item_type][item.id] = _catalog_entry(item)
+    with _catalog_lock:
+        # Don't cache catalogs that were invalidated while we were loading them
+        if generation == _catalog_generation:
+            _catalog_cache.update(loaded)
+    catalogs.update(loaded)
+    return catalogs
+
+def get_temple_catalog(temple_id):
+    """Return {'prasad': {id: item}, 'pooja': {id: item}} for a temple, loading it on first use"""
+    return load_temple_catalogs([temple_id])[temple_id]
+
+def invalidate_temple_catalog(temple_id=None):
+    """Drop the cached catalog for one temple, or for all temples"""
+    global _catalog_generation
+    with _catalog_lock:
+        _catalog_generation += 1
+        if temple_id is None:
+            _catalog_cache.clear()
+        else:
+            _catalog_cache.pop(temple_id, None)
+    bump_catalog_version(temple_id)
+
+# Version of everything the public temple pages show (temples, prasads, poojas), shared by all
+# processes through catalog_change. Each process checks it at most every CATALOG_SYNC_SECONDS
+# and drops its own catalog caches when another process changed the catalog.
+_catalog_version = None
+_catalog_modified = None
+_catalog_checked = 0.0
+_catalog_sync_lock = threading.Lock()
+
+def _drop_catalog_caches():
+    global _catalog_generation
+    with _catalog_lock:
+        _catalog_generation += 1
+        _catalog_cache.clear()
+    page_cache.invalidate()
+    temple_geo_index.reset()
+    search_index.reset()
+
+def sync_catalog_version():
+    """Pick up the current catalog version from the DB, at most every CATALOG_SYNC_SECONDS"""
+    global _catalog_version, _catalog_modified, _catalog_checked
+    if time.monotonic() - _catalog_checked < app.config['CATALOG_SYNC_SECONDS']:
+        return
+    with _catalog_sync_lock:
+        if time.monotonic() - _catalog_checked < app.config['CATALOG_SYNC_SECONDS']:
+            return
+        latest = db.session.query(CatalogChange.id, CatalogChange.changed_at).order_by(CatalogChange.id.desc()).first()
+        version, modified = latest or (0, None)
+        if _catalog_version is not None and version != _catalog_version:
+            _drop_catalog_caches()
+        _catalog_version, _catalog_modified = version, modified
+        _catalog_checked = time.monotonic()
+
+def bump_catalog_version(temple_id=None):
+    """Record a temple catalog change for every process and drop the pages rendered from the old version"""
+    global _catalog_version, _catalog_modified
+    changed_at = datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+    table = CatalogChange.__table__
+    with db.engine.begin() as conn:
+        version = conn.execute(table.insert().values(temple_id=temple_id, changed_at=changed_at)).inserted_primary_key[0]
+        conn.execute(table.delete().where(table.c.id <= version - app.config['CATALOG_CHANGE_LOG_SIZE']))
+    with _catalog_sync_lock:
+        # Versions we haven't seen in between came from other processes
+        if _catalog_version is not None and version != _catalog_version + 1:
+            _drop_catalog_caches()
+        else:
+            page_cache.invalidate()
+        if _catalog_version is None or version > _catalog_version:
+            _catalog_version, _catalog_modified = version, changed_at
+
+@app.before_request
+def sync_shared_caches():
+    """Finish process startup, then catch up with catalog and user changes made by other processes"""
+    if request.endpoint != 'static':
+        prepare_process()
+        sync_catalog_version()
+        user_cache.sync()
+
+def catalog_version_tag():
+    return str(_catalog_version)
+
+def catalog_changes_since(tag):
+    """Temple ids changed after the version in `tag`, or None when a full reload is needed"""
+    if not (tag or '').isdigit():
+        return None
+    version = int(tag)
+    current = _catalog_version
+    if version > current:
+        return None
+    if version == current:
+        return set()
+    rows = db.session.query(CatalogChange.id, CatalogChange.temple_id).filter(
+        CatalogChange.id > version, CatalogChange.id <= current
+    ).order_by(CatalogChange.id).all()
+    # The log must still reach back to the client's version
+    if not rows or rows[0][0] != version + 1:
+        return None
+    changed = set()
+    for _, temple_id in rows:
+        if temple_id is None:
+            return None
+        changed.add(temple_id)
+    return changed
+
+def resolve_order_items(temple_id, prasads=None, poojas=None, catalog=None):
+    """Price requested prasad/pooja lines from the temple catalog.
+    Raises ValueError for items that are unknown, unavailable or from another temple"""
+    if not prasads and not poojas:
+        return []
+    
+    if catalog is None:
+        catalog = get_temple_catalog(int(temple_id))
+    order_items = []
+    for item_type, requested in (('prasad', prasads or []), ('pooja', poojas or [])):
+        for entry in requested:
+            item = catalog[item_type].get(int(entry['id']))
+            if not item or not item['is_available']:
+                raise ValueError(f"{item_type.capitalize()} {entry['id']} is not available at this temple")
+            quantity = int(entry.get('quantity', 1)) if item_type == 'prasad' else 1
+            if quantity < 1:
+                raise ValueError(f'Invalid quantity for {item["name"]}')
+            order_items.append({
+                'type': item_type,
+                'id': item['id'],
+                'quantity': quantity,
+                'price': item['price'] * quantity,
+                'name': item['name'],
+                'unit_price': item['price'],
+                'duration': item['duration']
+            })
+    return order_items
+
+def describe_order_items(order):
+    """Split an order's items into prasad and pooja detail lists from the line snapshots"""
+    prasads = []
+    poojas = []
+    for item in order.items:
+        if item.item_type == 'prasad':
+            prasads.append({'name': item.name or f'Prasad #{item.item_id}', 'quantity': item.quantity, 'price': item.price})
+        else:
+            poojas.append({'name': item.name or f'Pooja #{item.item_id}', 'duration': item.duration, 'price': item.price})
+    return prasads, poojas
+
+class IdempotencyStore:
+    """Idempotency keys in the idempotency_key table, so a retry that lands on another
+    process still finds the first request. Each call runs in its own short transaction,
+    outside the view's session, so the claim is visible to other processes at once"""
+    
+    # A pending claim this old belongs to a request that died without completing
+    PENDING_TIMEOUT = 600
+    PRUNE_INTERVAL = 60
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._pruned = 0.0
+    
+    def _prune(self, conn, now):
+        if time.monotonic() - self._pruned < self.PRUNE_INTERVAL:
+            return
+        self._pruned = time.monotonic()
+        table = IdempotencyKey.__table__
+        conn.execute(table.delete().where(table.c.created_at < now - timedelta(seconds=self.ttl)))
+    
+    def begin(self, user_id, endpoint, key, fingerprint):
+        """Claim a key. Returns (claim_id, None, None) if the caller should run the request,
+        otherwise (None, 'pending' | 'mismatch' | 'done', row)"""
+        table = IdempotencyKey.__table__
+        match = (table.c.user_id == user_id, table.c.endpoint == endpoint, table.c.request_key == key)
+        for _ in range(2):
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            try:
+                with db.engine.begin() as conn:
+                    self._prune(conn, now)
+                    claim_id = conn.execute(table.insert().values(
+                        user_id=user_id, endpoint=endpoint, request_key=key, fingerprint=fingerprint,
+                        state='pending', created_at=now
+                    )).inserted_primary_key[0]
+                return claim_id, None, None
+            except IntegrityError:
+                pass
+            
+            with db.engine.begin() as conn:
+                row = conn.execute(db.select(table).where(*match)).first()
+                if row is None:
+                    continue  # discarded meanwhile, claim it again
+                expired = row.created_at < now - timedelta(seconds=self.ttl)
+                abandoned = row.state == 'pending' and row.created_at < now - timedelta(seconds=self.PENDING_TIMEOUT)
+                if not expired and not abandoned:
+                    if row.fingerprint != fingerprint:
+                        return None, 'mismatch', row
+                    return None, row.state, row
+                # Only one retry gets to drop the old row and claim the key
+                conn.execute(table.delete().where(table.c.id == row.id))
+        return None, 'pending', None
+    
+    def complete(self, claim_id, status, body, mimetype):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id == claim_id).values(
+                state='done', status_code=status, body=body, mimetype=mimetype
+            ))
+    
+    def discard(self, claim_id):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.id == claim_id))
+
+idempotency_store = IdempotencyStore(app.config['IDEMPOTENCY_KEY_TTL'])
+
+def idempotent(view):
+    """Replay the first response for a repeated Idempotency-Key instead of re-running the view"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'success': False, 'error': 'Idempotency-Key is too long'}), 400
+        
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        claim_id, state, row = idempotency_store.begin(current_user.id, request.endpoint, key, fingerprint)
+        if state == 'mismatch':
+            return jsonify({'success': False, 'error': 'Idempotency-Key was already used with a different request'}), 422
+        if state == 'pending':
+            return jsonify({'success': False, 'error': 'A request with this Idempotency-Key is still in progress'}), 409
+        if state == 'done':
+            response = app.response_class(row.body, status=row.status_code, mimetype=row.mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency_store.discard(claim_id)
+            raise
+        
+        # Server errors are not final, let the client retry them for real
+        if response.status_code >= 500:
+            idempotency_store.discard(claim_id)
+        else:
+            idempotency_store.complete(claim_id, response.status_code, response.get_data(), response.mimetype)
+        return response
+    return wrapper
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_request_queries(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+def query_budget(limit):
+    """Cap the SQL statements a view may run, including lazy loads during template rendering.
+    Over budget raises with QUERY_BUDGET_STRICT (tests) and logs a warning otherwise"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            start = g.get('query_count', 0)
+            response = view(*args, **kwargs)
+            used = g.get('query_count', 0) - start
+            if used > limit:
+                message = f'{request.endpoint} ran {used} queries, budget is {limit}'
+                if app.config['QUERY_BUDGET_STRICT']:
+                    raise QueryBudgetExceeded(message)
+                app.logger.warning(message)
+            return response
+        return wrapper
+    return decorator
+
+QR_CODE_PATTERN = re.compile(r'^[A-Z0-9]{1,100}$')
+
+class QRImageCache:
+    """Rendered QR images kept in an in-memory LRU backed by files on disk.
+    A code's image never changes, so entries are never invalidated"""
+    
+    FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+    
+    def __init__(self, directory, max_items, version):
+        self.directory = directory
+        self.max_items = max_items
+        self.version = version  # part of file names, so images of an older token format aren't reused
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, code, fmt='png', content=None):
+        """Return image bytes for code; content() supplies the text to encode on a miss"""
+        key = (code, fmt)
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data
+        
+        path = os.path.join(self.directory, f'{code}.v{self.version}.{fmt}')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = self._render(content() if content else code, fmt)
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        
+        with self._lock:
+            self._items[key] = data
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return data
+    
+    def _render(self, text, fmt):
+        buffer = io.BytesIO()
+        segno.make_qr(text, error='m').save(buffer, kind=fmt, scale=8, border=2)
+        return buffer.getvalue()
+
+# Bump when build_qr_token's payload changes (2: no pilgrim name, line names embedded)
+QR_TOKEN_VERSION = 2
+
+qr_images = QRImageCache(app.config['QR_CACHE_DIR'], app.config['QR_CACHE_SIZE'], QR_TOKEN_VERSION)
+
+def external_qr_url(qr_code, size=200):
+    """Fallback QR image when segno isn't installed"""
+    return f"https://api.qrserver.com/v1/create-qr-code/?size={size}x{size}&data={qr_code}"
+
+# QR images carry a signed token so gates can check a booking without the database.
+# The key must be its own secret: anyone holding it can mint gate tokens.
+if not app.config['QR_TOKEN_KEY'] or app.config['QR_TOKEN_KEY'] == app.config['SECRET_KEY']:
+    raise RuntimeError('Set QR_TOKEN_KEY to a random secret that is different from SECRET_KEY')
+
+qr_signer = URLSafeSerializer(app.config['QR_TOKEN_KEY'], salt='gate-qr',
+                              signer_kwargs={'digest_method': hashlib.sha256})
+
+def build_qr_token(order):
+    """Signed token with the order details the gate shows. The pilgrim's name is left out and
+    looked up at scan time; line names are the order's own snapshots, so they never go stale"""
+    booking = order.booking
+    return qr_signer.dumps({
+        'c': order.qr_code,
+        'o': order.id,
+        'b': booking.id,
+        't': booking.temple_id,
+        'tn': booking.temple.name,
+        'd': booking.date.isoformat(),
+        's': booking.time_slot,
+        'p': booking.persons,
+        'a': order.total_amount,
+        'i': [[item.item_type[:2], item.item_id, item.quantity, item.price, item.name, item.duration]
+              for item in order.items]
+    })
+
+def read_qr_token(token):
+    """Return the payload of a signed QR token, or None if it isn't authentic"""
+    try:
+        return qr_signer.loads(token)
+    except BadSignature:
+        return None
+
+def qr_token_content(code):
+    """Look up the order for a QR code and return its signed token"""
+    order = Order.query.filter_by(qr_code=code).first()
+    if not order:
+        raise LookupError(code)
+    return build_qr_token(order)
 
 def get_crowd_prediction(temple_id, date_str):
     """Dummy crowd prediction API"""
@@ -191,50 +1001,100 @@ def get_enhanced_crowd_status(count, temple_id):
     else:
         return 'High'
 
-def send_crowd_alert(temple_id=None):
-    """Send email alert to pilgrims when crowd status is High"""
+def claim_crowd_alert(temple_id):
+    """True if no alert went out for the temple within CROWD_ALERT_COOLDOWN, in any process.
+    The conditional UPDATE (or the INSERT for a first alert) lets exactly one caller win"""
+    table = CrowdAlert.__table__
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    cutoff = now - timedelta(seconds=app.config['CROWD_ALERT_COOLDOWN'])
+    with db.engine.begin() as conn:
+        won = conn.execute(table.update().where(
+            table.c.temple_id == temple_id, table.c.last_sent_at < cutoff
+        ).values(last_sent_at=now)).rowcount
+    if won:
+        return True
     try:
-        temple_name = 'the temple'
-        if temple_id:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(temple_id=temple_id, last_sent_at=now))
+        return True
+    except IntegrityError:
+        return False  # alerted within the cooldown
+
+def send_crowd_alert(temple_id):
+    """Queue email alerts to pilgrims booked at the temple soon when crowd status is High.
+    Repeat alerts for a temple are throttled and the fan-out runs in the background"""
+    if not claim_crowd_alert(temple_id):
+        return False
+    
+    socketio.start_background_task(_fan_out_crowd_alert, temple_id)
+    return True
+
+def _fan_out_crowd_alert(temple_id):
+    """Stream recipients in keyset-paginated chunks into the email outbox"""
+    with app.app_context():
+        try:
             temple = Temple.query.get(temple_id)
             temple_name = temple.name if temple else 'the temple'
-        
-        pilgrims = User.query.filter_by(role='pilgrim').all()
-        for pilgrim in pilgrims:
-            msg = Message(
-                subject=f'Temple Alert - High Crowd at {temple_name}',
-                recipients=[pilgrim.email],
-                body=f'Dear {pilgrim.name}, please note {temple_name} is currently overcrowded. Consider visiting at a different time.'
-            )
-            mail.send(msg)
-    except Exception as e:
-        print(f'Email sending failed: {e}')
+            today = local_today()
+            until = today + timedelta(days=app.config['CROWD_ALERT_WINDOW_DAYS'])
+            chunk_size = app.config['CROWD_ALERT_CHUNK_SIZE']
+            
+            last_user_id = 0
+            while True:
+                # DISTINCT on user id dedupes pilgrims with several bookings
+                recipients = db.session.query(User.id, User.name, User.email).join(
+                    Booking, Booking.user_id == User.id
+                ).filter(
+                    User.role == 'pilgrim',
+                    User.id > last_user_id,
+                    Booking.temple_id == temple_id,
+                    Booking.date >= today,
+                    Booking.date <= until,
+                    Booking.status != 'cancelled'
+                ).distinct().order_by(User.id).limit(chunk_size).all()
+                if not recipients:
+                    break
+                
+                now = datetime.now(timezone.utc)
+                db.session.execute(insert(EmailOutbox), [{
+                    'kind': 'crowd_alert',
+                    'recipient': pilgrim.email,
+                    'subject': f'Temple Alert - High Crowd at {temple_name}',
+                    'body': f'Dear {pilgrim.name}, please note {temple_name} is currently overcrowded. Consider visiting at a different time.',
+                    'status': 'pending',
+                    'attempts': 0,
+                    'next_attempt_at': now,
+                    'created_at': now
+                } for pilgrim in recipients])
+                db.session.commit()
+                email_outbox.wake()
+                last_user_id = recipients[-1].id
+        except Exception as e:
+            db.session.rollback()
+            print(f'Email sending failed: {e}')
+        finally:
+            db.session.remove()
 
-def send_booking_confirmation_email(booking, qr_code, order_amount):
-    """Send booking confirmation email with QR code"""
-    try:
-        temple = booking.temple
-        user = booking.user
-        
-        # Get order items if any
-        prasad_items = []
-        pooja_items = []
-        
-        if qr_code:
-            order = Order.query.filter_by(qr_code=qr_code).first()
-            if order:
-                for item in order.items:
-                    if item.item_type == 'prasad':
-                        prasad = Prasad.query.get(item.item_id)
-                        if prasad:
-                            prasad_items.append(f'{prasad.name} x{item.quantity} - ₹{item.price}')
-                    elif item.item_type == 'pooja':
-                        pooja = Pooja.query.get(item.item_id)
-                        if pooja:
-                            pooja_items.append(f'{pooja.name} ({pooja.duration}min) - ₹{item.price}')
-        
-        # Create email content
-        email_body = f"""Dear {user.name},
+def build_booking_confirmation_email(booking, qr_code, order_amount):
+    """Build the booking confirmation email with QR code"""
+    temple = booking.temple
+    user = booking.user
+    
+    # Get order items if any
+    prasad_items = []
+    pooja_items = []
+    
+    if qr_code:
+        order = Order.query.filter_by(qr_code=qr_code).first()
+        if order:
+            prasads, poojas = describe_order_items(order)
+            for prasad in prasads:
+                prasad_items.append(f"{prasad['name']} x{prasad['quantity']} - ₹{prasad['price']}")
+            for pooja in poojas:
+                pooja_items.append(f"{pooja['name']} ({pooja['duration']}min) - ₹{pooja['price']}")
+    
+    # Create email content
+    email_body = f"""Dear {user.name},
 
 Your temple booking has been confirmed! 🙏
 
@@ -246,29 +1106,31 @@ Your temple booking has been confirmed! 🙏
 🔖 Confirmation ID: {booking.confirmation_id}
 
 💰 Darshan Fee: ₹{booking.persons * 50}"""
-        
-        # Always include QR code section with image URL
-        qr_image_url = f"https://api.qrserver.com/v1/create-qr-code/?size=200x200&data={qr_code}"
-        email_body += f"\n\n📱 Your QR Code: {qr_code}"
-        email_body += f"\n\n🖼️ QR Code Image: {qr_image_url}"
-        email_body += "\n\n⚡ IMPORTANT: Show this QR code at temple entrance for verification!"
-        email_body += "\n(You can scan the QR code image above or show this email to temple staff)"
-        
-        if prasad_items or pooja_items:
-            email_body += f"\n\n🛍️ Pre-booked Services (₹{order_amount}):"
-            if prasad_items:
-                email_body += "\n\n📦 Prasad Items:"
-                for item in prasad_items:
-                    email_body += f"\n• {item}"
-            if pooja_items:
-                email_body += "\n\n🕯️ Pooja Services:"
-                for item in pooja_items:
-                    email_body += f"\n• {item}"
-            email_body += "\n\n⚡ Show QR code at Pre-booked Collection counter for services!"
-        else:
-            email_body += "\n\n🙏 This QR code is for darshan entry verification."
-        
-        email_body += f"""\n\n📋 Instructions:
+    
+    # Always include QR code section, the image is attached inline when we can render it
+    qr_cid = f'qr-{qr_code}'
+    qr_image_url = f'cid:{qr_cid}' if segno is not None else external_qr_url(qr_code)
+    qr_image_label = f'attached ({qr_code}.png)' if segno is not None else qr_image_url
+    email_body += f"\n\n📱 Your QR Code: {qr_code}"
+    email_body += f"\n\n🖼️ QR Code Image: {qr_image_label}"
+    email_body += "\n\n⚡ IMPORTANT: Show this QR code at temple entrance for verification!"
+    email_body += "\n(You can scan the QR code image above or show this email to temple staff)"
+    
+    if prasad_items or pooja_items:
+        email_body += f"\n\n🛍️ Pre-booked Services (₹{order_amount}):"
+        if prasad_items:
+            email_body += "\n\n📦 Prasad Items:"
+            for item in prasad_items:
+                email_body += f"\n• {item}"
+        if pooja_items:
+            email_body += "\n\n🕯️ Pooja Services:"
+            for item in pooja_items:
+                email_body += f"\n• {item}"
+        email_body += "\n\n⚡ Show QR code at Pre-booked Collection counter for services!"
+    else:
+        email_body += "\n\n🙏 This QR code is for darshan entry verification."
+    
+    email_body += f"""\n\n📋 Instructions:
 1. Arrive at {temple.name} on {booking.date.strftime('%d %B %Y')}
 2. Report to the temple between {booking.time_slot}
 3. Show this email and QR code (if applicable) for verification
@@ -281,33 +1143,406 @@ Thank you for choosing Divine Darshan!
 
 Blessings,
 Temple Management Team"""
+    
+    # Create HTML version with embedded QR code image
+    html_body = email_body.replace('\n', '<br>').replace(f'QR Code Image: {qr_image_label}', f'<br><img src="{qr_image_url}" alt="QR Code" style="width:200px;height:200px;"><br>')
+    
+    msg = Message(
+        subject=f'🕉️ Booking Confirmed - {temple.name} | {booking.confirmation_id}',
+        recipients=[user.email],
+        body=email_body,
+        html=html_body
+    )
+    if qr_code and segno is not None:
+        msg.attach(f'{qr_code}.png', 'image/png', qr_images.get(qr_code, 'png', lambda: qr_token_content(qr_code)), 'inline',
+                   headers={'Content-ID': f'<{qr_cid}>'})
+    return msg
+
+def queue_email(recipient, subject=None, body=None, html=None, kind='plain', booking_id=None):
+    """Add an email to the outbox in the caller's transaction; it is sent once that commits"""
+    entry = EmailOutbox(kind=kind, booking_id=booking_id, recipient=recipient,
+                        subject=subject, body=body, html=html)
+    db.session.add(entry)
+    return entry
+
+def build_outbox_message(entry):
+    """Render an outbox row into a Message"""
+    if entry.kind == 'booking_confirmation':
+        booking = Booking.query.get(entry.booking_id)
+        if not booking:
+            raise ValueError(f'Booking {entry.booking_id} no longer exists')
+        order = booking.orders[0] if booking.orders else None
+        msg = build_booking_confirmation_email(booking, order.qr_code if order else None,
+                                               order.total_amount if order else 0)
+        msg.recipients = [entry.recipient]
+        return msg
+    return Message(subject=entry.subject, recipients=[entry.recipient], body=entry.body, html=entry.html)
+
+def _outbox_due(now):
+    # Rows claimed by a worker that died are picked up again after 10 minutes
+    return db.or_(
+        db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - timedelta(minutes=10))
+    )
+
+def claim_outbox_batch(limit):
+    """Atomically claim up to limit due outbox rows for this worker"""
+    now = datetime.now(timezone.utc)
+    ids = [row.id for row in db.session.query(EmailOutbox.id).filter(_outbox_due(now))
+           .order_by(EmailOutbox.id).limit(limit).all()]
+    if not ids:
+        db.session.rollback()
+        return []
+    
+    token = uuid.uuid4().hex
+    EmailOutbox.query.filter(EmailOutbox.id.in_(ids), _outbox_due(now)).update(
+        {'status': 'sending', 'claim_token': token, 'claimed_at': now}, synchronize_session=False
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claim_token=token, status='sending').all()
+
+class EmailOutboxWorker:
+    """Pool of background threads draining email_outbox.
+    Each thread keeps its SMTP connection open between batches until it has been idle a while"""
+    
+    def __init__(self, app):
+        self.app = app
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+    
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.app.config['EMAIL_OUTBOX_WORKERS']):
+                thread = threading.Thread(target=self._run, name=f'email-outbox-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+    
+    def wake(self):
+        self.start()
+        self._wake.set()
+    
+    def _run(self):
+        connection = None
+        last_used = time.monotonic()
+        while True:
+            self._wake.wait(timeout=self.app.config['EMAIL_OUTBOX_POLL_INTERVAL'])
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    while True:
+                        batch = claim_outbox_batch(self.app.config['EMAIL_OUTBOX_BATCH_SIZE'])
+                        if not batch:
+                            break
+                        connection = self._deliver(batch, connection)
+                        last_used = time.monotonic()
+                    db.session.remove()
+            except Exception as e:
+                print(f'Email outbox worker error: {e}')
+            
+            if connection and time.monotonic() - last_used > self.app.config['EMAIL_SMTP_IDLE_TIMEOUT']:
+                connection = self._close(connection)
+    
+    def _open(self):
+        # Entered by hand so the connection can outlive a single batch
+        return mail.connect().__enter__()
+    
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+        return None
+    
+    def _deliver(self, batch, connection):
+        sent_ids = []
+        now = datetime.now(timezone.utc)
+        for entry in batch:
+            try:
+                msg = build_outbox_message(entry)
+                if connection is None:
+                    connection = self._open()
+                try:
+                    connection.send(msg)
+                except Exception:
+                    # Don't reuse a connection that just failed
+                    connection = self._close(connection)
+                    raise
+                sent_ids.append(entry.id)
+            except Exception as e:
+                entry.attempts += 1
+                entry.last_error = str(e)[:500]
+                entry.claim_token = None
+                if entry.attempts >= self.app.config['EMAIL_OUTBOX_MAX_ATTEMPTS']:
+                    entry.status = 'failed'
+                else:
+                    delay = self.app.config['EMAIL_OUTBOX_RETRY_DELAY'] * 2 ** (entry.attempts - 1)
+                    entry.status = 'pending'
+                    entry.next_attempt_at = now + timedelta(seconds=delay)
         
-        # Create HTML version with embedded QR code image
-        html_body = email_body.replace('\n', '<br>').replace(f'QR Code Image: {qr_image_url}', f'<br><img src="{qr_image_url}" alt="QR Code" style="width:200px;height:200px;"><br>')
+        if sent_ids:
+            EmailOutbox.query.filter(EmailOutbox.id.in_(sent_ids)).update(
+                {'status': 'sent', 'claim_token': None}, synchronize_session=False
+            )
+        db.session.commit()
+        return connection
+
+email_outbox = EmailOutboxWorker(app)
+
+class ResultCache:
+    """Keyed results with a TTL. Concurrent misses for the same key wait for a single
+    computation instead of each running the query (single flight)"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            waiter = self._inflight.get(key)
+            leader = waiter is None
+            if leader:
+                waiter = self._inflight[key] = threading.Event()
+                generation = self._generation
         
-        msg = Message(
-            subject=f'🕉️ Booking Confirmed - {temple.name} | {booking.confirmation_id}',
-            recipients=[user.email],
-            body=email_body,
-            html=html_body
-        )
-        mail.send(msg)
+        if not leader:
+            waiter.wait(timeout=30)
+            with self._lock:
+                entry = self._entries.get(key)
+            # The leader failed or was invalidated, compute our own copy
+            return entry[1] if entry is not None else compute()
         
-    except Exception as e:
-        print(f'Booking confirmation email failed: {e}')
+        try:
+            value = compute()
+            with self._lock:
+                # Don't store a result that a write invalidated while it was computing
+                if generation == self._generation:
+                    self._entries[key] = (time.monotonic() + self.ttl, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            waiter.set()
+    
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+# Dashboard numbers may trail writes by up to ANALYTICS_CACHE_TTL. Writes don't clear it: that
+# would only reach this process and, under steady traffic, keep the cache from ever being warm
+analytics_cache = ResultCache(app.config['ANALYTICS_CACHE_TTL'])
+
+page_cache = ResultCache(app.config['PAGE_CACHE_TTL'])
+
+def catalog_page(template, key, render_content):
+    """Render a public page around a content fragment cached per catalog version.
+    The fragment only varies by key and login state; the navbar and flashes are rendered per request"""
+    authenticated = current_user.is_authenticated
+    version = _catalog_version
+    content = page_cache.get_or_compute((template, key, version, authenticated), render_content)
+    response = app.make_response(render_template(template, content=Markup(content)))
+    
+    # Pending flash messages make the page one-off, so only plain views get validators
+    if '_flashes' not in session:
+        user_key = current_user.get_id() if authenticated else '-'
+        response.set_etag(f'{version}-{key}-{user_key}', weak=True)
+        if _catalog_modified:
+            response.last_modified = _catalog_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        response.make_conditional(request)
+    return response
+
+# Analytics queries: each is one GROUP BY, so cost doesn't grow with temples or days
+EMPTY_BOOKING_TOTALS = {'bookings': 0, 'visitors': 0, 'revenue': 0}
+
+# Date ranges. Timestamps are stored as naive UTC; "days" are calendar days in APP_TIMEZONE.
+# Filters compare the raw column against [start, end) bounds so created_at indexes stay usable.
+APP_TZ = ZoneInfo(app.config['APP_TIMEZONE'])
+
+def local_today():
+    return datetime.now(APP_TZ).date()
+
+def local_date(moment):
+    """Calendar day in APP_TIMEZONE of a stored UTC timestamp"""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(APP_TZ).date()
+
+def _day_start_utc(day):
+    return datetime.combine(day, dtime.min, APP_TZ).astimezone(timezone.utc).replace(tzinfo=None)
+
+def day_bounds(first_day, last_day=None):
+    """Naive UTC [start, end) covering local days first_day..last_day inclusive"""
+    last_day = last_day or first_day
+    return _day_start_utc(first_day), _day_start_utc(last_day + timedelta(days=1))
+
+def month_bounds(day):
+    """Naive UTC [start, end) covering the local month containing day"""
+    first_day = day.replace(day=1)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    return _day_start_utc(first_day), _day_start_utc(next_month)
+
+def created_within(column, bounds):
+    """Sargable half-open range filter on a timestamp column"""
+    start, end = bounds
+    return db.and_(column >= start, column < end)
+
+def local_day_expr(column):
+    """SQL expression for the local calendar day of a UTC timestamp, for SELECT/GROUP BY only"""
+    return db.func.date(db.func.convert_tz(column, '+00:00', sql_time_zone()))
+
+_sql_time_zone = None
+
+def sql_time_zone():
+    """APP_TIMEZONE as a CONVERT_TZ argument. A named zone applies each row's own offset, but needs
+    MySQL's time zone tables; without them fall back to the zone's current fixed offset, which is
+    exact for zones without DST such as the default Asia/Kolkata"""
+    global _sql_time_zone
+    if _sql_time_zone is None:
+        name = app.config['APP_TIMEZONE']
+        converted = db.session.execute(text("SELECT CONVERT_TZ('2024-01-01 00:00:00', '+00:00', :tz)"),
+                                       {'tz': name}).scalar()
+        if converted is not None:
+            _sql_time_zone = name
+        else:
+            offset = int(datetime.now(APP_TZ).utcoffset().total_seconds() // 60)
+            hours, minutes = divmod(abs(offset), 60)
+            fixed = f"{'-' if offset < 0 else '+'}{hours:02d}:{minutes:02d}"
+            year = local_today().year
+            has_dst = (datetime(year, 1, 1, tzinfo=APP_TZ).utcoffset() != datetime(year, 7, 1, tzinfo=APP_TZ).utcoffset())
+            app.logger.warning(
+                f'MySQL does not know time zone {name!r}, grouping days at fixed offset {fixed}'
+                + ('; days across DST changes will be off, load the time zone tables with mysql_tzinfo_to_sql' if has_dst else '')
+            )
+            _sql_time_zone = fixed
+    return _sql_time_zone
+
+ROLLUP_COUNTERS = ('bookings', 'paid_bookings', 'visitors', 'revenue', 'prasad_revenue', 'pooja_revenue')
+
+def bump_daily_stats(increments):
+    """Add counter increments to daily_temple_stats in the caller's transaction.
+    Each increment is a dict with day, temple_id and any of ROLLUP_COUNTERS"""
+    if not increments:
+        return
+    table = DailyTempleStats.__table__
+    rows = [{**dict.fromkeys(ROLLUP_COUNTERS, 0), **increment} for increment in increments]
+    stmt = mysql_insert(table)
+    stmt = stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in ROLLUP_COUNTERS})
+    db.session.execute(stmt, rows)
+
+def record_paid_booking(booking):
+    """Roll a booking whose payment just completed into its day's stats"""
+    prasad_revenue = 0
+    pooja_revenue = 0
+    for order in booking.orders:
+        for item in order.items:
+            if item.item_type == 'prasad':
+                prasad_revenue += item.price
+            else:
+                pooja_revenue += item.price
+    bump_daily_stats([{
+        'day': local_date(booking.created_at or datetime.now(timezone.utc)),
+        'temple_id': booking.temple_id,
+        'paid_bookings': 1,
+        'visitors': booking.persons,
+        'revenue': booking.total_amount,
+        'prasad_revenue': prasad_revenue,
+        'pooja_revenue': pooja_revenue
+    }])
+
+def rebuild_daily_stats(start_day, end_day):
+    """Recompute daily_temple_stats for local days [start_day, end_day) from the booking tables"""
+    start, _ = day_bounds(start_day)
+    end, _ = day_bounds(end_day)
+    day_sql = "DATE(CONVERT_TZ(b.created_at, '+00:00', :tz))"
+    params = {'start_day': start_day, 'end_day': end_day, 'start': start, 'end': end, 'tz': sql_time_zone()}
+    db.session.execute(text("DELETE FROM daily_temple_stats WHERE day >= :start_day AND day < :end_day"), params)
+    db.session.execute(text(f"""
+        INSERT INTO daily_temple_stats
+            (day, temple_id, bookings, paid_bookings, visitors, revenue, prasad_revenue, pooja_revenue)
+        SELECT {day_sql}, b.temple_id, COUNT(*),
+               SUM(b.payment_status = 'completed'),
+               SUM(CASE WHEN b.payment_status = 'completed' THEN b.persons ELSE 0 END),
+               SUM(CASE WHEN b.payment_status = 'completed' THEN b.total_amount ELSE 0 END),
+               SUM(CASE WHEN b.payment_status = 'completed' THEN COALESCE(li.prasad_revenue, 0) ELSE 0 END),
+               SUM(CASE WHEN b.payment_status = 'completed' THEN COALESCE(li.pooja_revenue, 0) ELSE 0 END)
+        FROM booking b
+        LEFT JOIN (
+            SELECT o.booking_id,
+                   SUM(CASE WHEN oi.item_type = 'prasad' THEN oi.price ELSE 0 END) AS prasad_revenue,
+                   SUM(CASE WHEN oi.item_type = 'pooja' THEN oi.price ELSE 0 END) AS pooja_revenue
+            FROM `order` o
+            JOIN order_item oi ON oi.order_id = o.id
+            JOIN booking ob ON ob.id = o.booking_id
+            WHERE ob.created_at >= :start AND ob.created_at < :end
+            GROUP BY o.booking_id
+        ) li ON li.booking_id = b.id
+        WHERE b.created_at >= :start AND b.created_at < :end AND b.temple_id IS NOT NULL
+        GROUP BY {day_sql}, b.temple_id
+    """), params)
+    db.session.commit()
+
+@app.cli.command('rebuild-daily-stats')
+@click.option('--days', default=3, help='Number of most recent days to recompute')
+def rebuild_daily_stats_command(days):
+    """Reconcile the daily stats rollup, meant to run nightly from cron"""
+    end_day = local_today() + timedelta(days=1)
+    rebuild_daily_stats(end_day - timedelta(days=days), end_day)
+    print(f'Rebuilt daily stats for the last {days} days')
+
+def booking_totals_by_temple():
+    """{temple_id: {'bookings', 'visitors', 'revenue'}}; visitors and revenue count completed payments only"""
+    completed = Booking.payment_status == 'completed'
+    rows = db.session.query(
+        Booking.temple_id,
+        db.func.count(Booking.id),
+        db.func.sum(db.case((completed, Booking.persons), else_=0)),
+        db.func.sum(db.case((completed, Booking.total_amount), else_=0))
+    ).group_by(Booking.temple_id).all()
+    return {
+        temple_id: {'bookings': bookings, 'visitors': int(visitors or 0), 'revenue': float(revenue or 0)}
+        for temple_id, bookings, visitors, revenue in rows
+    }
+
+def daily_booking_stats(days):
+    """Completed bookings, visitors and revenue per creation day for the last N days, newest first"""
+    today = local_today()
+    day = local_day_expr(Booking.created_at)
+    rows = db.session.query(
+        day,
+        db.func.count(Booking.id),
+        db.func.sum(Booking.persons),
+        db.func.sum(Booking.total_amount)
+    ).filter(
+        created_within(Booking.created_at, day_bounds(today - timedelta(days=days - 1), today)),
+        Booking.payment_status == 'completed'
+    ).group_by(day).all()
+    
+    found = {str(row_day)[:10]: (bookings, visitors, revenue) for row_day, bookings, visitors, revenue in rows}
+    stats = {}
+    for i in range(days):
+        key = (today - timedelta(days=i)).strftime('%Y-%m-%d')
+        bookings, visitors, revenue = found.get(key, (0, 0, 0))
+        stats[key] = {'bookings': bookings, 'visitors': int(visitors or 0), 'revenue': float(revenue or 0)}
+    return stats
 
 # Routes
 @app.route('/')
 def index():
-    temples = Temple.query.filter_by(is_active=True).all()
-    # Ensure all temples have crowd data
-    for temple in temples:
-        existing_crowd = Crowd.query.filter_by(temple_id=temple.id).first()
-        if not existing_crowd:
-            crowd = Crowd(temple_id=temple.id, status='Low', count=0, accuracy=1.0)
-            db.session.add(crowd)
-    db.session.commit()
-    return render_template('index.html', temples=temples)
+    return catalog_page('index.html', 'index', lambda: render_template(
+        'fragments/index.html', temples=Temple.query.filter_by(is_active=True).all()
+    ))
 
 @app.route('/index')
 def old_index():
@@ -321,14 +1556,24 @@ def register():
         password = request.form['password']
         role = request.form.get('role', 'pilgrim')
         
+        if auth_rate_limited(email):
+            flash('Too many attempts, please wait a minute and try again')
+            return render_template('register.html'), 429
+        
         if User.query.filter_by(email=email).first():
             flash('Email already exists')
             return redirect(url_for('register'))
         
+        try:
+            password_hash = password_hasher.hash(password)
+        except HasherBusy:
+            flash('We are seeing a lot of sign-ups, please try again shortly')
+            return render_template('register.html'), 503
+        
         user = User(
             name=name,
             email=email,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
             role=role
         )
         db.session.add(user)
@@ -345,9 +1590,24 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
+        if auth_rate_limited(email):
+            flash('Too many attempts, please wait a minute and try again')
+            return render_template('login.html'), 429
+        
         user = User.query.filter_by(email=email).first()
         
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            # Unknown emails are hashed too, so timing doesn't reveal which accounts exist
+            valid = password_hasher.verify(user.password_hash if user else None, password)
+            # Move old hashes to the configured method/cost while we have the plain password
+            if valid and password_hasher.needs_rehash(user.password_hash):
+                user.password_hash = password_hasher.hash(password)
+                db.session.commit()
+        except HasherBusy:
+            flash('We are seeing a lot of logins, please try again shortly')
+            return render_template('login.html'), 503
+        
+        if valid:
             login_user(user)
             if user.role == 'admin':
                 return redirect(url_for('admin'))
@@ -366,17 +1626,24 @@ def logout():
 
 @app.route('/temples')
 def temples():
-    temples = Temple.query.filter_by(is_active=True).all()
-    return render_template('temples.html', temples=temples)
+    return catalog_page('temples.html', 'temples', lambda: render_template(
+        'fragments/temples.html', temples=Temple.query.filter_by(is_active=True).all()
+    ))
 
 @app.route('/temple/<int:temple_id>')
 def temple_detail(temple_id):
+    today = local_today()
+    return catalog_page('temple_detail.html', f'temple-{temple_id}-{today.isoformat()}',
+                        lambda: render_temple_detail(temple_id, today))
+
+def render_temple_detail(temple_id, today):
+    """Temple info and booking form; the crowd card is filled in client-side"""
     temple = Temple.query.get_or_404(temple_id)
-    crowd = Crowd.query.filter_by(temple_id=temple_id).order_by(Crowd.updated_at.desc()).first()
-    prasads = Prasad.query.filter_by(temple_id=temple_id, is_available=True).all()
-    poojas = Pooja.query.filter_by(temple_id=temple_id, is_available=True).all()
-    today = datetime.now().strftime('%Y-%m-%d')
-    return render_template('temple_detail.html', temple=temple, crowd=crowd, prasads=prasads, poojas=poojas, today=today)
+    catalog = get_temple_catalog(temple_id)
+    prasads = [p for p in catalog['prasad'].values() if p['is_available']]
+    poojas = [p for p in catalog['pooja'].values() if p['is_available']]
+    return render_template('fragments/temple_detail.html', temple=temple, prasads=prasads, poojas=poojas,
+                           today=today.strftime('%Y-%m-%d'))
 
 
 
@@ -389,32 +1656,137 @@ def booking_confirmation(booking_id):
         return redirect(url_for('my_bookings'))
     return render_template('booking_confirmation.html', booking=booking)
 
+# Keyset pagination over (created_at, id), newest first. Cursors are "<created_at>-<id>"
+# so a page costs one index range scan no matter how deep it is
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+def encode_cursor(booking):
+    return f"{booking.created_at.strftime('%Y%m%d%H%M%S%f')}-{booking.id}"
+
+def decode_cursor(cursor):
+    created_at, _, booking_id = cursor.partition('-')
+    return datetime.strptime(created_at, '%Y%m%d%H%M%S%f'), int(booking_id)
+
+def keyset_page(query, after=None, before=None, size=None):
+    """One page of bookings older than `after` (next) or newer than `before` (previous).
+    Raises ValueError on a malformed cursor"""
+    size = size or app.config['BOOKINGS_PAGE_SIZE']
+    if before:
+        created_at, booking_id = decode_cursor(before)
+        query = query.filter(db.or_(
+            Booking.created_at > created_at,
+            db.and_(Booking.created_at == created_at, Booking.id > booking_id)
+        )).order_by(Booking.created_at.asc(), Booking.id.asc())
+    else:
+        if after:
+            created_at, booking_id = decode_cursor(after)
+            query = query.filter(db.or_(
+                Booking.created_at < created_at,
+                db.and_(Booking.created_at == created_at, Booking.id < booking_id)
+            ))
+        query = query.order_by(Booking.created_at.desc(), Booking.id.desc())
+    
+    # One extra row tells us whether there is another page in this direction
+    rows = query.limit(size + 1).all()
+    more = len(rows) > size
+    rows = rows[:size]
+    if before:
+        rows.reverse()
+        has_older, has_newer = True, more
+    else:
+        has_older, has_newer = more, bool(after)
+    
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(rows[-1]) if rows and has_older else None,
+        prev_cursor=encode_cursor(rows[0]) if rows and has_newer else None
+    )
+
+def approximate_booking_total(temple_id=None):
+    """Booking count from the daily rollup instead of COUNT(*) over the bookings table"""
+    query = db.session.query(db.func.sum(DailyTempleStats.bookings))
+    if temple_id:
+        query = query.filter(DailyTempleStats.temple_id == temple_id)
+    return int(query.scalar() or 0)
+
+def booking_summary(booking, include_user=False):
+    summary = {
+        'id': booking.id,
+        'confirmation_id': booking.confirmation_id,
+        'temple_id': booking.temple_id,
+        'temple_name': booking.temple.name if booking.temple else None,
+        'date': booking.date.isoformat(),
+        'time_slot': booking.time_slot,
+        'persons': booking.persons,
+        'total_amount': booking.total_amount,
+        'status': booking.status,
+        'payment_status': booking.payment_status,
+        'created_at': booking.created_at.isoformat(),
+        'orders': [{
+            'id': order.id,
+            'qr_code': order.qr_code,
+            'total_amount': order.total_amount,
+            'status': order.status
+        } for order in booking.orders]
+    }
+    if include_user:
+        summary['user'] = {'id': booking.user.id, 'name': booking.user.name, 'email': booking.user.email}
+    return summary
+
+def my_bookings_query():
+    return Booking.query.filter_by(user_id=current_user.id).options(
+        joinedload(Booking.temple), selectinload(Booking.orders)
+    )
+
 @app.route('/my-bookings')
 @login_required
 def my_bookings():
     if current_user.role != 'pilgrim':
         return redirect(url_for('admin'))
     
-    bookings = Booking.query.filter_by(user_id=current_user.id).order_by(Booking.created_at.desc()).all()
-    return render_template('my_bookings.html', bookings=bookings)
+    try:
+        page = keyset_page(my_bookings_query(), request.args.get('after'), request.args.get('before'))
+    except ValueError:
+        return redirect(url_for('my_bookings'))
+    return render_template('my_bookings.html', bookings=page.items, page=page)
+
+@app.route('/api/my-bookings')
+@login_required
+def my_bookings_api():
+    try:
+        page = keyset_page(my_bookings_query(), request.args.get('after'), request.args.get('before'),
+                           min(request.args.get('limit', type=int) or app.config['BOOKINGS_PAGE_SIZE'], 100))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'bookings': [booking_summary(booking) for booking in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor
+    })
 
 @app.route('/admin')
 @login_required
+@query_budget(8)
 def admin():
     if current_user.role != 'admin':
         return redirect(url_for('book'))
     
-    bookings = Booking.query.join(User).join(Temple).order_by(Booking.created_at.desc()).limit(20).all()
+    bookings = Booking.query.options(joinedload(Booking.user), joinedload(Booking.temple)).order_by(
+        Booking.created_at.desc()
+    ).limit(20).all()
     temples = Temple.query.all()
     total_bookings = Booking.query.count()
     crowd = Crowd.query.order_by(Crowd.updated_at.desc()).first()
-    if not crowd:
-        crowd = Crowd(status='Low', count=0)
-        db.session.add(crowd)
-        db.session.commit()
     
     return render_template('admin.html', bookings=bookings, temples=temples, 
-                         total_bookings=total_bookings, crowd_status=crowd.status, crowd_count=crowd.count)
+                         total_bookings=total_bookings,
+                         crowd_status=crowd.status if crowd else 'Low', crowd_count=crowd.count if crowd else 0)
 
 @app.route('/admin/dashboard')
 @login_required
@@ -423,36 +1795,24 @@ def admin_dashboard():
         return redirect(url_for('index'))
     
     # Analytics data
-    today = datetime.now().date()
     temples = Temple.query.all()
     total_users = User.query.count()
-    total_bookings = Booking.query.count()
-    total_revenue = db.session.query(db.func.sum(Booking.total_amount)).filter(
-        Booking.payment_status == 'completed'
-    ).scalar() or 0
+    temple_totals = analytics_cache.get_or_compute(('booking_totals',), booking_totals_by_temple)
+    total_bookings = sum(totals['bookings'] for totals in temple_totals.values())
+    total_revenue = sum(totals['revenue'] for totals in temple_totals.values())
     
     # Daily visitors for last 7 days
-    daily_visitors = []
-    for i in range(7):
-        date = today - timedelta(days=i)
-        count = Booking.query.filter(
-            db.func.date(Booking.created_at) == date,
-            Booking.payment_status == 'completed'
-        ).count()
-        daily_visitors.append({'date': date.strftime('%Y-%m-%d'), 'count': count})
+    daily_counts = analytics_cache.get_or_compute(('daily_booking_stats', local_today(), 7), lambda: daily_booking_stats(7))
+    daily_visitors = [{'date': day, 'count': daily_counts[day]['bookings']} for day in daily_counts]
     
     # Temple-wise bookings
     temple_bookings = []
     for temple in temples:
-        count = Booking.query.filter_by(temple_id=temple.id).count()
-        revenue = db.session.query(db.func.sum(Booking.total_amount)).filter(
-            Booking.temple_id == temple.id,
-            Booking.payment_status == 'completed'
-        ).scalar() or 0
+        totals = temple_totals.get(temple.id, EMPTY_BOOKING_TOTALS)
         temple_bookings.append({
             'name': temple.name,
-            'bookings': count,
-            'revenue': revenue
+            'bookings': totals['bookings'],
+            'revenue': totals['revenue']
         })
     
     return render_template('admin_dashboard.html',
@@ -502,6 +1862,9 @@ def add_temple():
         )
         db.session.add(crowd)
         db.session.commit()
+        bump_catalog_version(temple.id)
+        temple_geo_index.upsert(temple)
+        search_index.index_temple(temple)
         flash('Temple added successfully')
         return redirect(url_for('admin_temples'))
     
@@ -528,6 +1891,9 @@ def edit_temple(temple_id):
         temple.is_active = 'is_active' in request.form
         
         db.session.commit()
+        bump_catalog_version(temple_id)
+        temple_geo_index.upsert(temple)
+        search_index.index_temple(temple)
         flash('Temple updated successfully')
         return redirect(url_for('admin_temples'))
     
@@ -542,26 +1908,31 @@ def delete_temple(temple_id):
     temple = Temple.query.get_or_404(temple_id)
     temple.is_active = False
     db.session.commit()
+    bump_catalog_version(temple_id)
+    temple_geo_index.upsert(temple)
+    search_index.index_temple(temple)
     flash('Temple deactivated successfully')
     return redirect(url_for('admin_temples'))
 
+def admin_bookings_query(temple_id=None):
+    query = Booking.query.options(joinedload(Booking.user), joinedload(Booking.temple), selectinload(Booking.orders))
+    if temple_id:
+        query = query.filter(Booking.temple_id == temple_id)
+    return query
+
 @app.route('/admin/bookings')
 @login_required
 def admin_bookings():
     if current_user.role != 'admin':
         return redirect(url_for('index'))
     
-    page = request.args.get('page', 1, type=int)
     temple_id = request.args.get('temple_id', type=int)
     
-    query = Booking.query.join(User).join(Temple)
-    
-    if temple_id:
-        query = query.filter(Booking.temple_id == temple_id)
-    
-    bookings = query.order_by(Booking.created_at.desc()).paginate(
-        page=page, per_page=20, error_out=False
-    )
+    try:
+        bookings = keyset_page(admin_bookings_query(temple_id), request.args.get('after'), request.args.get('before'))
+    except ValueError:
+        return redirect(url_for('admin_bookings', temple_id=temple_id))
+    bookings.total = analytics_cache.get_or_compute(('booking_total', temple_id), lambda: approximate_booking_total(temple_id))
     
     temples = Temple.query.all()
     
@@ -570,81 +1941,200 @@ def admin_bookings():
                          temples=temples, 
                          selected_temple=temple_id)
 
+EXPORT_COLUMNS = (
+    'booking_id', 'confirmation_id', 'created_at', 'visit_date', 'time_slot', 'persons',
+    'booking_amount', 'payment_status', 'transaction_id', 'booking_status',
+    'user_id', 'user_name', 'user_email', 'temple_id', 'temple_name',
+    'order_id', 'qr_code', 'order_amount', 'order_status', 'collected_at',
+    'item_type', 'item_id', 'item_name', 'quantity', 'unit_price', 'line_total'
+)
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def export_rows(query, fmt):
+    """Encode streamed result rows as CSV or NDJSON, a batch at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+    
+    count = 0
+    for row in query:
+        values = [export_value(value) for value in row]
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values)), separators=(',', ':')))
+            buffer.write('\n')
+        count += 1
+        if count % app.config['EXPORT_BATCH_SIZE'] == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route('/api/admin/bookings')
+@login_required
+def admin_bookings_api():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    temple_id = request.args.get('temple_id', type=int)
+    try:
+        page = keyset_page(admin_bookings_query(temple_id), request.args.get('after'), request.args.get('before'),
+                           min(request.args.get('limit', type=int) or app.config['BOOKINGS_PAGE_SIZE'], 100))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    result = {
+        'bookings': [booking_summary(booking, include_user=True) for booking in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor
+    }
+    if request.args.get('total') == 'approx':
+        result['approximate_total'] = analytics_cache.get_or_compute(
+            ('booking_total', temple_id), lambda: approximate_booking_total(temple_id)
+        )
+    return jsonify(result)
+
+@app.route('/admin/bookings/export')
+@login_required
+def export_bookings():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    
+    temple_id = request.args.get('temple_id', type=int)
+    payment_status = request.args.get('payment_status')
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.strptime(start, '%Y-%m-%d').date() if start else None
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD'}), 400
+    
+    # One row per order line; bookings without an order still get a row
+    query = db.session.query(
+        Booking.id, Booking.confirmation_id, Booking.created_at, Booking.date, Booking.time_slot,
+        Booking.persons, Booking.total_amount, Booking.payment_status, Booking.transaction_id, Booking.status,
+        User.id, User.name, User.email, Temple.id, Temple.name,
+        Order.id, Order.qr_code, Order.total_amount, Order.status, Order.collected_at,
+        OrderItem.item_type, OrderItem.item_id, OrderItem.name, OrderItem.quantity, OrderItem.unit_price, OrderItem.price
+    ).join(User, Booking.user_id == User.id).join(Temple, Booking.temple_id == Temple.id).outerjoin(
+        Order, Order.booking_id == Booking.id
+    ).outerjoin(OrderItem, OrderItem.order_id == Order.id)
+    
+    if temple_id:
+        query = query.filter(Booking.temple_id == temple_id)
+    if payment_status:
+        query = query.filter(Booking.payment_status == payment_status)
+    if start:
+        query = query.filter(Booking.created_at >= day_bounds(start)[0])
+    if end:
+        query = query.filter(Booking.created_at < day_bounds(end)[1])
+    
+    # yield_per streams from a server-side cursor instead of buffering the whole result
+    query = query.order_by(Booking.id, Order.id, OrderItem.id).execution_options(
+        yield_per=app.config['EXPORT_BATCH_SIZE']
+    )
+    
+    filename = f"bookings-{local_today().isoformat()}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_rows(query, fmt)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+def ensure_crowd_rows():
+    """Give every temple without crowd data a starting 'Low' row. Runs at startup and from
+    the admin tools so read paths never have to write. Returns the number of rows added"""
+    missing = [temple_id for (temple_id,) in db.session.query(Temple.id).outerjoin(
+        Crowd, Crowd.temple_id == Temple.id
+    ).filter(Crowd.id.is_(None)).all()]
+    if missing:
+        db.session.execute(insert(Crowd), [
+            {'temple_id': temple_id, 'status': 'Low', 'count': 0, 'accuracy': 1.0,
+             'updated_at': datetime.now(timezone.utc)}
+            for temple_id in missing
+        ])
+        db.session.commit()
+    return len(missing)
+
 @app.route('/admin/init-crowd-data')
 @login_required
 def init_crowd_data():
     if current_user.role != 'admin':
         return redirect(url_for('index'))
     
-    # Initialize crowd data for temples that don't have it
-    temples = Temple.query.filter_by(is_active=True).all()
-    initialized = 0
-    
-    for temple in temples:
-        existing_crowd = Crowd.query.filter_by(temple_id=temple.id).first()
-        if not existing_crowd:
-            crowd = Crowd(
-                temple_id=temple.id,
-                status='Low',
-                count=0,
-                accuracy=1.0
-            )
-            db.session.add(crowd)
-            initialized += 1
-    
-    db.session.commit()
+    initialized = ensure_crowd_rows()
     flash(f'Initialized crowd data for {initialized} temples')
     return redirect(url_for('admin_temples'))
 
-@app.route('/api/admin/analytics')
-@login_required
-def admin_analytics_api():
-    if current_user.role != 'admin':
-        return jsonify({'error': 'Unauthorized'}), 403
+def admin_analytics_data():
+    """30-day series and per-temple totals over the same 30 days for /api/admin/analytics.
+    Both read only that range of the rollup, so cost doesn't grow with the days recorded"""
+    # Daily visitors for last 30 days, read from the rollup
+    today = local_today()
+    since = today - timedelta(days=29)
+    daily_rows = db.session.query(
+        DailyTempleStats.day,
+        db.func.sum(DailyTempleStats.visitors),
+        db.func.sum(DailyTempleStats.revenue),
+        db.func.sum(DailyTempleStats.prasad_revenue),
+        db.func.sum(DailyTempleStats.pooja_revenue)
+    ).filter(DailyTempleStats.day >= since).group_by(DailyTempleStats.day).all()
+    by_day = {row[0]: row[1:] for row in daily_rows}
     
-    # Daily visitors for last 30 days
-    today = datetime.now().date()
     daily_data = []
-    
     for i in range(30):
         date = today - timedelta(days=i)
-        visitors = db.session.query(db.func.sum(Booking.persons)).filter(
-            db.func.date(Booking.created_at) == date,
-            Booking.payment_status == 'completed'
-        ).scalar() or 0
-        
-        revenue = db.session.query(db.func.sum(Booking.total_amount)).filter(
-            db.func.date(Booking.created_at) == date,
-            Booking.payment_status == 'completed'
-        ).scalar() or 0
-        
+        visitors, revenue, prasad_revenue, pooja_revenue = by_day.get(date, (0, 0, 0, 0))
         daily_data.append({
             'date': date.strftime('%Y-%m-%d'),
-            'visitors': visitors,
-            'revenue': float(revenue)
+            'visitors': int(visitors or 0),
+            'revenue': float(revenue or 0),
+            'prasad_revenue': float(prasad_revenue or 0),
+            'pooja_revenue': float(pooja_revenue or 0)
         })
     
-    # Temple-wise statistics
-    temple_stats = []
-    temples = Temple.query.filter_by(is_active=True).all()
+    # Temple-wise statistics for the same 30 days
+    temple_rows = db.session.query(
+        DailyTempleStats.temple_id,
+        db.func.sum(DailyTempleStats.bookings),
+        db.func.sum(DailyTempleStats.visitors)
+    ).filter(DailyTempleStats.day >= since).group_by(DailyTempleStats.temple_id).all()
+    by_temple = {temple_id: (bookings, visitors) for temple_id, bookings, visitors in temple_rows}
     
-    for temple in temples:
-        bookings = Booking.query.filter_by(temple_id=temple.id).count()
-        visitors = db.session.query(db.func.sum(Booking.persons)).filter(
-            Booking.temple_id == temple.id,
-            Booking.payment_status == 'completed'
-        ).scalar() or 0
-        
+    temple_stats = []
+    for temple in Temple.query.filter_by(is_active=True).all():
+        bookings, visitors = by_temple.get(temple.id, (0, 0))
         temple_stats.append({
             'name': temple.name,
-            'bookings': bookings,
-            'visitors': visitors
+            'bookings': int(bookings or 0),
+            'visitors': int(visitors or 0)
         })
     
-    return jsonify({
+    return {
         'daily_data': daily_data,
         'temple_stats': temple_stats
-    })
+    }
+
+@app.route('/api/admin/analytics')
+@login_required
+def admin_analytics_api():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify(analytics_cache.get_or_compute(('admin_analytics', local_today()), admin_analytics_data))
 
 @app.route('/update-crowd', methods=['POST'])
 @login_required
@@ -654,17 +2144,16 @@ def update_crowd():
             return jsonify({'error': 'Unauthorized'}), 403
         return redirect(url_for('book'))
     
-    if request.is_json:
-        temple_id = request.json.get('temple_id')
-        status = request.json.get('status', 'Low')
-        count = int(request.json.get('count', 0))
-    else:
-        temple_id = request.form.get('temple_id')
-        status = request.form.get('status', 'Low')
-        count = int(request.form.get('count', 0))
-    
-    if not temple_id:
+    data = request.json if request.is_json else request.form
+    if not data.get('temple_id'):
         return jsonify({'error': 'Temple ID required'}), 400
+    # Validate before anything is written, so a bad value can't fail after the update went out
+    try:
+        temple_id = int(data.get('temple_id'))
+        count = int(data.get('count', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'temple_id and count must be numbers'}), 400
+    status = data.get('status', 'Low')
     
     crowd = Crowd.query.filter_by(temple_id=temple_id).order_by(Crowd.updated_at.desc()).first()
     if crowd:
@@ -683,9 +2172,8 @@ def update_crowd():
         'accuracy': crowd.accuracy
     })
     
-    # Crowd alert disabled to prevent unwanted emails
-    # if status == 'High':
-    #     send_crowd_alert(temple_id)
+    if status == 'High':
+        send_crowd_alert(temple_id)
     
     if request.is_json:
         return jsonify({'success': True})
@@ -694,40 +2182,366 @@ def update_crowd():
     return redirect(url_for('admin'))
 
 # API Routes
+EARTH_RADIUS_KM = 6371.0
+CROWD_LEVELS = {'Low': 0, 'Medium': 1, 'High': 2}
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+class TempleGeoIndex:
+    """Active temples bucketed into a lat/lng grid, so a radius query only looks at nearby cells.
+    Loaded from the DB on first use and kept current by upsert/remove from the temple admin routes"""
+    
+    def __init__(self, cell_degrees):
+        self.cell_degrees = cell_degrees
+        # Longitude columns are stretched slightly so a whole number of them spans 360 degrees
+        self.lng_columns = math.ceil(360 / cell_degrees)
+        self.lng_degrees = 360 / self.lng_columns
+        self._cells = {}
+        self._temples = {}  # temple_id -> cell
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def _cell(self, lat, lng):
+        # Columns wrap around at the antimeridian, so -180 and 180 are neighbours
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.lng_degrees)) % self.lng_columns
+    
+    def _add(self, temple):
+        if not temple.is_active or temple.latitude is None or temple.longitude is None:
+            return
+        cell = self._cell(temple.latitude, temple.longitude)
+        self._temples[temple.id] = cell
+        self._cells.setdefault(cell, {})[temple.id] = temple_payload(temple)
+    
+    def _drop(self, temple_id):
+        cell = self._temples.pop(temple_id, None)
+        if cell is not None:
+            entries = self._cells[cell]
+            entries.pop(temple_id, None)
+            if not entries:
+                del self._cells[cell]
+    
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                for temple in Temple.query.filter_by(is_active=True).all():
+                    self._add(temple)
+                self._loaded = True
+    
+    def upsert(self, temple):
+        with self._lock:
+            if self._loaded:
+                self._drop(temple.id)
+                self._add(temple)
+    
+    def reset(self):
+        """Forget every temple; the next query reloads them from the DB"""
+        with self._lock:
+            self._cells.clear()
+            self._temples.clear()
+            self._loaded = False
+    
+    def nearby(self, lat, lng, radius_km, limit=None):
+        """[(distance_km, entry)] within radius_km, nearest first"""
+        self.ensure_loaded()
+        lat_cells = math.ceil(radius_km / 111.0 / self.cell_degrees)
+        # Widest longitude reach of the search circle; near the poles it covers every column
+        angle = radius_km / EARTH_RADIUS_KM
+        cos_lat = math.cos(math.radians(lat))
+        if angle >= math.pi / 2 or math.sin(angle) >= cos_lat:
+            lng_cells = self.lng_columns // 2
+        else:
+            lng_span = math.degrees(math.asin(math.sin(angle) / cos_lat))
+            lng_cells = min(math.ceil(lng_span / self.lng_degrees), self.lng_columns // 2)
+        row, col = self._cell(lat, lng)
+        columns = {c % self.lng_columns for c in range(col - lng_cells, col + lng_cells + 1)}
+        
+        found = []
+        with self._lock:
+            for r in range(row - lat_cells, row + lat_cells + 1):
+                for c in columns:
+                    for entry in self._cells.get((r, c), {}).values():
+                        distance = haversine_km(lat, lng, entry['latitude'], entry['longitude'])
+                        if distance <= radius_km:
+                            found.append((distance, entry))
+        found.sort(key=lambda item: item[0])
+        return found[:limit] if limit else found
+
+temple_geo_index = TempleGeoIndex(app.config['NEARBY_CELL_DEGREES'])
+
+SEARCH_TOKEN = re.compile(r'\w+', re.UNICODE)
+SEARCH_WEIGHTS = {'name': 3.0, 'location': 2.0, 'description': 1.0, 'temple': 0.5}
+
+def search_tokens(text_value):
+    return SEARCH_TOKEN.findall((text_value or '').lower())
+
+class SearchIndex:
+    """Inverted index over active temples and their available prasads and poojas.
+    The last query word matches as a prefix (typeahead), earlier words must match whole tokens"""
+    
+    def __init__(self):
+        self._postings = {}  # token -> {doc_key: weight}
+        self._docs = {}  # doc_key -> (result dict, tokens)
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def _add(self, key, result, fields):
+        self._drop(key)
+        weights = {}
+        for field, value in fields.items():
+            for token in search_tokens(value):
+                weights[token] = max(weights.get(token, 0), SEARCH_WEIGHTS[field])
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                self._vocabulary_dirty = True
+            self._postings[token][key] = weight
+        self._docs[key] = (result, set(weights))
+    
+    def _drop(self, key):
+        doc = self._docs.pop(key, None)
+        if doc:
+            for token in doc[1]:
+                postings = self._postings[token]
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[token]
+                    self._vocabulary_dirty = True
+    
+    def _add_temple(self, temple):
+        if not temple.is_active:
+            self._drop(('temple', temple.id))
+            return
+        self._add(('temple', temple.id), {'type': 'temple', 'id': temple.id, 'name': temple.name,
+                                          'location': temple.location, 'temple_id': temple.id},
+                  {'name': temple.name, 'location': temple.location, 'description': temple.description})
+        # Offerings are also found by their temple's name, so reindex them under the new one
+        for key, (result, _) in list(self._docs.items()):
+            if key[0] != 'temple' and result['temple_id'] == temple.id:
+                self._add(key, result, {'name': result['name'], 'temple': temple.name})
+    
+    def _add_item(self, item_type, item):
+        if not item.is_available:
+            self._drop((item_type, item.id))
+            return
+        temple = self._docs.get(('temple', item.temple_id))
+        self._add((item_type, item.id), {'type': item_type, 'id': item.id, 'name': item.name,
+                                         'price': item.price, 'temple_id': item.temple_id},
+                  {'name': item.name, 'temple': temple[0]['name'] if temple else None})
+    
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                for temple in Temple.query.filter_by(is_active=True).all():
+                    self._add_temple(temple)
+                for item_type, model in (('prasad', Prasad), ('pooja', Pooja)):
+                    for item in model.query.filter_by(is_available=True).all():
+                        self._add_item(item_type, item)
+                self._loaded = True
+    
+    def index_temple(self, temple):
+        with self._lock:
+            if self._loaded:
+                self._add_temple(temple)
+    
+    def index_item(self, item_type, item):
+        with self._lock:
+            if self._loaded:
+                self._add_item(item_type, item)
+    
+    def remove(self, item_type, item_id):
+        with self._lock:
+            self._drop((item_type, item_id))
+    
+    def reset(self):
+        """Forget every document; the next search reloads them from the DB"""
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._vocabulary = []
+            self._vocabulary_dirty = False
+            self._loaded = False
+    
+    def _expand(self, prefix):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        start = bisect_left(self._vocabulary, prefix)
+        for token in self._vocabulary[start:start + app.config['SEARCH_MAX_EXPANSIONS']]:
+            if not token.startswith(prefix):
+                break
+            yield token
+    
+    def search(self, query, limit):
+        self.ensure_loaded()
+        tokens = search_tokens(query)
+        if not tokens:
+            return []
+        
+        with self._lock:
+            scores = None
+            for position, token in enumerate(tokens):
+                matches = {}
+                if position == len(tokens) - 1:
+                    for candidate in self._expand(token):
+                        # Whole-word hits outrank prefix hits
+                        factor = 1.0 if candidate == token else 0.5
+                        for key, weight in self._postings[candidate].items():
+                            matches[key] = max(matches.get(key, 0), weight * factor)
+                else:
+                    matches = dict(self._postings.get(token, {}))
+                scores = matches if scores is None else {
+                    key: score + matches[key] for key, score in scores.items() if key in matches
+                }
+                if not scores:
+                    return []
+            
+            results = []
+            for key, score in scores.items():
+                result = self._docs[key][0]
+                temple = self._docs.get(('temple', result['temple_id']))
+                if temple is None:
+                    continue  # offering of an inactive temple
+                # Temples first on ties, then by name
+                results.append((-score, key[0] != 'temple', result['name'], dict(result, temple_name=temple[0]['name'])))
+        results.sort(key=lambda item: item[:3])
+        return [item[3] for item in results[:limit]]
+
+search_index = SearchIndex()
+
+_process_prepared = False
+_process_prepared_lock = threading.Lock()
+
+def prepare_process():
+    """Startup work for each app process, run before its first request however it was started
+    (python app.py, flask run, gunicorn): crowd rows for new temples, the SQL time zone check,
+    search and nearby indexes"""
+    global _process_prepared
+    if _process_prepared:
+        return
+    with _process_prepared_lock:
+        if not _process_prepared:
+            ensure_crowd_rows()
+            sql_time_zone()
+            search_index.ensure_loaded()
+            temple_geo_index.ensure_loaded()
+            _process_prepared = True
+
+@app.cli.command('prepare-data')
+def prepare_data_command():
+    """Give temples created outside the admin pages their crowd rows; run on deploy"""
+    added = ensure_crowd_rows()
+    print(f"Initialized crowd data for {added} temples")
+
+def temple_payload(temple):
+    return {
+        'id': temple.id, 'name': temple.name, 'location': temple.location,
+        'latitude': temple.latitude, 'longitude': temple.longitude,
+        'capacity': temple.capacity, 'image_url': temple.image_url
+    }
+
+def temples_json():
+    temples = Temple.query.filter_by(is_active=True).all()
+    return json.dumps([temple_payload(t) for t in temples], separators=(',', ':'))
+
 @app.route('/api/temples')
 def api_temples():
-    temples = Temple.query.filter_by(is_active=True).all()
-    return jsonify([{
-        'id': t.id, 'name': t.name, 'location': t.location,
-        'latitude': t.latitude, 'longitude': t.longitude,
-        'capacity': t.capacity, 'image_url': t.image_url
-    } for t in temples])
+    # The ETag is the shared catalog version, so a poll with a current ETag runs no queries of its own
+    version = catalog_version_tag()
+    since = request.args.get('since')
+    if since:
+        # Delta polls carry their version in the URL, a current one costs no queries
+        response = temples_delta(since, version)
+    elif request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+        response.set_etag(version)
+    else:
+        body = page_cache.get_or_compute(('api_temples', version), temples_json)
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(version)
+    response.headers['X-Catalog-Version'] = version
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def temples_delta(since, version):
+    """Temples added/changed and ids removed since a version the client already has"""
+    changed = catalog_changes_since(since)
+    if changed is None:
+        # Unknown or too old a version: hand back the full list
+        temples = json.loads(page_cache.get_or_compute(('api_temples', version), temples_json))
+        return jsonify({'version': version, 'full': True, 'temples': temples, 'removed': []})
+    
+    temples = Temple.query.filter(Temple.id.in_(changed), Temple.is_active == True).all() if changed else []
+    removed = sorted(changed - {t.id for t in temples})
+    return jsonify({'version': version, 'full': False, 'temples': [temple_payload(t) for t in temples], 'removed': removed})
+
+@app.route('/api/search')
+def api_search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'results': []})
+    limit = min(request.args.get('limit', type=int) or 10, 50)
+    return jsonify({'results': search_index.search(query[:100], limit)})
+
+@app.route('/api/temples/nearby')
+def api_temples_nearby():
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    # float() accepts nan and inf, which compare False against any range
+    if lat is None or lng is None or not math.isfinite(lat) or not math.isfinite(lng):
+        return jsonify({'error': 'lat and lng are required'}), 400
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return jsonify({'error': 'lat must be within [-90, 90] and lng within [-180, 180]'}), 400
+    max_radius = app.config['NEARBY_MAX_RADIUS_KM']
+    radius = request.args.get('radius', type=float)
+    if 'radius' not in request.args:
+        radius = min(50, max_radius)
+    if radius is None or not math.isfinite(radius) or not 0 < radius <= max_radius:
+        return jsonify({'error': f'radius must be greater than 0 and at most {max_radius} km'}), 400
+    limit = max(1, min(request.args.get('limit', type=int) or 20, 100))
+    
+    rank_by_crowd = request.args.get('rank') == 'crowd'
+    
+    results = temple_geo_index.nearby(lat, lng, radius, None if rank_by_crowd else limit)
+    temples = [dict(entry, distance_km=round(distance, 2)) for distance, entry in results]
+    
+    if rank_by_crowd and temples:
+        # Quieter temples first, then by distance; one query for the latest crowd rows
+        latest = {}
+        for crowd in Crowd.query.filter(Crowd.temple_id.in_([t['id'] for t in temples])).order_by(Crowd.updated_at).all():
+            latest[crowd.temple_id] = crowd
+        for temple in temples:
+            crowd = latest.get(temple['id'])
+            temple['crowd_status'] = crowd.status if crowd else 'Low'
+            temple['crowd_count'] = crowd.count if crowd else 0
+        temples.sort(key=lambda t: (CROWD_LEVELS.get(t['crowd_status'], 0), t['distance_km']))
+        temples = temples[:limit]
+    
+    return jsonify({'temples': temples, 'radius_km': radius})
 
 @app.route('/api/book', methods=['POST'])
 @login_required
+@idempotent
 def api_book():
     try:
         data = request.json
         confirmation_id = generate_confirmation_id()
         
+        # Resolve all requested services against the temple catalog up front
+        order_items = resolve_order_items(data.get('temple_id'), data.get('prasads'), data.get('poojas'))
+        
         # Calculate total amount
         darshan_fee = data['persons'] * 50
-        services_amount = 0
-        
-        # Calculate services amount
-        if 'prasads' in data and data['prasads']:
-            for prasad_data in data['prasads']:
-                prasad = Prasad.query.get(prasad_data['id'])
-                if prasad:
-                    services_amount += prasad.price * prasad_data['quantity']
-        
-        if 'poojas' in data and data['poojas']:
-            for pooja_data in data['poojas']:
-                pooja = Pooja.query.get(pooja_data['id'])
-                if pooja:
-                    services_amount += pooja.price
-        
-        total_amount = darshan_fee + services_amount
+        total_order_amount = sum(item['price'] for item in order_items)
+        total_amount = darshan_fee + total_order_amount
         
         booking = Booking(
             user_id=current_user.id,
@@ -743,35 +2557,6 @@ def api_book():
         db.session.add(booking)
         db.session.flush()  # Get booking ID
         
-        # Process prasad and pooja orders if any
-        total_order_amount = 0
-        order_items = []
-        
-        if 'prasads' in data and data['prasads']:
-            for prasad_data in data['prasads']:
-                prasad = Prasad.query.get(prasad_data['id'])
-                if prasad:
-                    quantity = prasad_data['quantity']
-                    total_order_amount += prasad.price * quantity
-                    order_items.append({
-                        'type': 'prasad',
-                        'id': prasad.id,
-                        'quantity': quantity,
-                        'price': prasad.price * quantity
-                    })
-        
-        if 'poojas' in data and data['poojas']:
-            for pooja_data in data['poojas']:
-                pooja = Pooja.query.get(pooja_data['id'])
-                if pooja:
-                    total_order_amount += pooja.price
-                    order_items.append({
-                        'type': 'pooja',
-                        'id': pooja.id,
-                        'quantity': 1,
-                        'price': pooja.price
-                    })
-        
         # Always create order with QR code for every booking
         qr_code = generate_qr_code()
         order = Order(
@@ -789,10 +2574,14 @@ def api_book():
                 item_type=item['type'],
                 item_id=item['id'],
                 quantity=item['quantity'],
-                price=item['price']
+                price=item['price'],
+                name=item['name'],
+                unit_price=item['unit_price'],
+                duration=item['duration']
             )
             db.session.add(order_item)
         
+        bump_daily_stats([{'day': local_date(booking.created_at), 'temple_id': booking.temple_id, 'bookings': 1}])
         db.session.commit()
         
         # Email will be sent after payment completion
@@ -817,15 +2606,152 @@ def api_book():
             'qr_code': qr_code,
             'order_amount': total_order_amount if total_order_amount > 0 else 0
         })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/bookings/bulk', methods=['POST'])
+@login_required
+@idempotent
+def api_bulk_book():
+    """Book a batch of slots in one transaction. Either every booking is created or none is"""
+    data = request.json or {}
+    requested = data.get('bookings') or []
+    if not requested:
+        return jsonify({'success': False, 'error': 'No bookings provided'}), 400
+    if len(requested) > app.config['BULK_BOOKING_MAX_SIZE']:
+        return jsonify({'success': False, 'error': f"At most {app.config['BULK_BOOKING_MAX_SIZE']} bookings per request"}), 400
+    
+    # Load every referenced temple and its catalog in one pass
+    temple_ids = set()
+    for entry in requested:
+        try:
+            temple_ids.add(int(entry['temple_id']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    temples = {t.id: t for t in Temple.query.filter(Temple.id.in_(temple_ids), Temple.is_active == True).all()}
+    catalogs = load_temple_catalogs(temples.keys())
+    
+    now = datetime.now(timezone.utc)
+    rows = []
+    errors = []
+    for index, entry in enumerate(requested):
+        try:
+            temple_id = int(entry['temple_id'])
+            if temple_id not in temples:
+                raise ValueError('Temple not found')
+            persons = int(entry['persons'])
+            if persons < 1:
+                raise ValueError('persons must be at least 1')
+            if not entry['time_slot']:
+                raise ValueError('time_slot is required')
+            booking_date = datetime.strptime(entry['date'], '%Y-%m-%d').date()
+            order_items = resolve_order_items(temple_id, entry.get('prasads'), entry.get('poojas'), catalogs[temple_id])
+        except KeyError as e:
+            errors.append({'index': index, 'error': f'Missing field {e}'})
+            continue
+        except (TypeError, ValueError) as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        
+        order_amount = sum(item['price'] for item in order_items)
+        rows.append({
+            'booking': {
+                'user_id': current_user.id,
+                'temple_id': temple_id,
+                'date': booking_date,
+                'time_slot': entry['time_slot'],
+                'persons': persons,
+                'confirmation_id': generate_confirmation_id(),
+                'total_amount': persons * 50 + order_amount,
+                'status': 'pending',
+                'payment_status': 'pending',
+                'created_at': now
+            },
+            'qr_code': generate_qr_code(),
+            'order_amount': order_amount,
+            'items': order_items
+        })
+    
+    if errors:
+        return jsonify({'success': False, 'errors': errors}), 400
+    
+    try:
+        # Ids are generated locally, so rows can be inserted in bulk and read back by their unique codes
+        db.session.execute(insert(Booking), [row['booking'] for row in rows])
+        booking_ids = dict(db.session.query(Booking.confirmation_id, Booking.id).filter(
+            Booking.confirmation_id.in_([row['booking']['confirmation_id'] for row in rows])
+        ).all())
+        
+        db.session.execute(insert(Order), [{
+            'booking_id': booking_ids[row['booking']['confirmation_id']],
+            'total_amount': row['order_amount'],
+            'qr_code': row['qr_code'],
+            'status': 'pending',
+            'created_at': now
+        } for row in rows])
+        order_ids = dict(db.session.query(Order.qr_code, Order.id).filter(
+            Order.qr_code.in_([row['qr_code'] for row in rows])
+        ).all())
+        
+        item_rows = [{
+            'order_id': order_ids[row['qr_code']],
+            'item_type': item['type'],
+            'item_id': item['id'],
+            'quantity': item['quantity'],
+            'price': item['price'],
+            'name': item['name'],
+            'unit_price': item['unit_price'],
+            'duration': item['duration']
+        } for row in rows for item in row['items']]
+        if item_rows:
+            db.session.execute(insert(OrderItem), item_rows)
+        
+        per_temple = {}
+        for row in rows:
+            temple_id = row['booking']['temple_id']
+            per_temple[temple_id] = per_temple.get(temple_id, 0) + 1
+        bump_daily_stats([{'day': local_date(now), 'temple_id': temple_id, 'bookings': count}
+                          for temple_id, count in per_temple.items()])
+        
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    results = [{
+        'booking_id': booking_ids[row['booking']['confirmation_id']],
+        'temple_id': row['booking']['temple_id'],
+        'confirmation_id': row['booking']['confirmation_id'],
+        'total_amount': row['booking']['total_amount'],
+        'qr_code': row['qr_code'],
+        'order_amount': row['order_amount']
+    } for row in rows]
+    
+    # One summary event for the whole batch
+    socketio.emit('bulk_booking', {
+        'user': current_user.name,
+        'count': len(results),
+        'persons': sum(row['booking']['persons'] for row in rows),
+        'temple_ids': sorted({row['booking']['temple_id'] for row in rows})
+    })
+    
+    return jsonify({
+        'success': True,
+        'count': len(results),
+        'total_amount': sum(result['total_amount'] for result in results),
+        'bookings': results
+    })
+
 @app.route('/api/temple/<int:temple_id>/crowd')
 def api_temple_crowd(temple_id):
     crowd = Crowd.query.filter_by(temple_id=temple_id).order_by(Crowd.updated_at.desc()).first()
     if crowd:
-        return jsonify({'status': crowd.status, 'count': crowd.count, 'accuracy': crowd.accuracy})
-    return jsonify({'status': 'Low', 'count': 0, 'accuracy': 0.0})
+        return jsonify({'status': crowd.status, 'count': crowd.count, 'accuracy': crowd.accuracy,
+                        'updated_at': crowd.updated_at.isoformat() if crowd.updated_at else None})
+    return jsonify({'status': 'Low', 'count': 0, 'accuracy': 0.0, 'updated_at': None})
 
 @app.route('/api/available-slots')
 def available_slots():
@@ -867,13 +2793,6 @@ def crowd_status():
     temple_id = request.args.get('temple_id')
     if temple_id:
         crowd = Crowd.query.filter_by(temple_id=temple_id).order_by(Crowd.updated_at.desc()).first()
-        if not crowd:
-            # Create crowd data if it doesn't exist
-            temple = Temple.query.get(temple_id)
-            if temple and temple.is_active:
-                crowd = Crowd(temple_id=temple_id, status='Low', count=0, accuracy=1.0)
-                db.session.add(crowd)
-                db.session.commit()
     else:
         crowd = Crowd.query.order_by(Crowd.updated_at.desc()).first()
     
@@ -884,13 +2803,6 @@ def crowd_status():
 @app.route('/crowd')
 def crowd_page():
     temples = Temple.query.filter_by(is_active=True).all()
-    # Ensure all temples have crowd data
-    for temple in temples:
-        existing_crowd = Crowd.query.filter_by(temple_id=temple.id).first()
-        if not existing_crowd:
-            crowd = Crowd(temple_id=temple.id, status='Low', count=0, accuracy=1.0)
-            db.session.add(crowd)
-    db.session.commit()
     return render_template('crowd.html', temples=temples)
 
 @app.route('/live-detection/<int:temple_id>')
@@ -963,6 +2875,9 @@ def detect_crowd_route():
         
         if file.filename == '' or not temple_id:
             return jsonify({'error': 'File and temple selection required'}), 400
+        if not temple_id.isdigit():
+            return jsonify({'error': 'Invalid temple'}), 400
+        temple_id = int(temple_id)
         
         filename = secure_filename(file.filename)
         filepath = os.path.join('uploads', filename)
@@ -971,7 +2886,7 @@ def detect_crowd_route():
         try:
             file.save(filepath)
             count, accuracy = enhanced_detect_crowd(filepath)
-            status = get_enhanced_crowd_status(count, int(temple_id))
+            status = get_enhanced_crowd_status(count, temple_id)
             
             crowd = Crowd(
                 temple_id=temple_id,
@@ -990,9 +2905,8 @@ def detect_crowd_route():
                 'accuracy': accuracy
             })
             
-            # Crowd alert disabled to prevent unwanted emails
-            # if status == 'High':
-            #     send_crowd_alert(temple_id)
+            if status == 'High':
+                send_crowd_alert(temple_id)
             
             return jsonify({
                 'count': count,
@@ -1021,8 +2935,279 @@ def qr_scan():
         return redirect(url_for('index'))
     return render_template('qr_scan.html')
 
+@app.route('/qr/<code>.<any(png, svg):fmt>')
+@login_required
+def qr_image(code, fmt):
+    """The image is a valid gate pass, so only the order's pilgrim and admins get it"""
+    if not QR_CODE_PATTERN.match(code):
+        return jsonify({'error': 'Invalid QR code'}), 404
+    if current_user.role != 'admin':
+        owner_id = db.session.query(Booking.user_id).join(Order, Order.booking_id == Booking.id).filter(
+            Order.qr_code == code
+        ).scalar()
+        # Someone else's code looks exactly like a missing one
+        if owner_id != current_user.id:
+            return jsonify({'error': 'Invalid QR code'}), 404
+    if segno is None:
+        return redirect(external_qr_url(code))
+    
+    etag = f'{code}.v{QR_TOKEN_VERSION}.{fmt}'
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        try:
+            data = qr_images.get(code, fmt, lambda: qr_token_content(code))
+        except LookupError:
+            return jsonify({'error': 'Invalid QR code'}), 404
+        response = app.response_class(data, mimetype=QRImageCache.FORMATS[fmt])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    response.vary.add('Cookie')
+    return response
+
+def qr_token_has_names(payload):
+    """Tokens issued before line names were embedded carry 4-field item entries"""
+    return all(len(entry) >= 6 for entry in payload['i'])
+
+def describe_qr_token(payload, status, user_name, order_items=()):
+    """Gate view of a signed QR token. Line names come from the token; order_items
+    (the order's line snapshots) are only needed for older tokens without them"""
+    lines = {(item.item_type[:2], item.item_id): item for item in order_items}
+    prasads = []
+    poojas = []
+    for entry in payload['i']:
+        kind, item_id, quantity, price = entry[:4]
+        if len(entry) >= 6:
+            name, duration = entry[4], entry[5]
+        else:
+            line = lines.get((kind, item_id))
+            name, duration = (line.name, line.duration) if line else (None, None)
+        if kind == 'pr':
+            prasads.append({'name': name or f'Prasad #{item_id}', 'quantity': quantity, 'price': price})
+        else:
+            poojas.append({'name': name or f'Pooja #{item_id}', 'duration': duration, 'price': price})
+    
+    darshan_fee = payload['p'] * 50
+    return {
+        'success': True,
+        'signed': True,
+        'order_id': payload['o'],
+        'booking_id': payload['b'],
+        'qr_code': payload['c'],
+        'user_name': user_name,
+        'temple_name': payload['tn'],
+        'booking_date': datetime.strptime(payload['d'], '%Y-%m-%d').strftime('%d %B %Y'),
+        'time_slot': payload['s'],
+        'persons': payload['p'],
+        'total_amount': darshan_fee + payload['a'],
+        'darshan_fee': darshan_fee,
+        'services_amount': payload['a'],
+        'prasads': prasads,
+        'poojas': poojas,
+        'status': status
+    }
+
+def parse_scanned_at(value, now):
+    """Naive UTC time of an offline gate scan from an ISO 8601 string (UTC if it has no offset),
+    clamped to the last COLLECT_SCAN_MAX_AGE_HOURS so a bad device clock can't skew the records.
+    Raises ValueError for anything that isn't a timestamp"""
+    if not isinstance(value, str):
+        raise ValueError(value)
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    oldest = now - timedelta(hours=app.config['COLLECT_SCAN_MAX_AGE_HOURS'])
+    return min(max(moment, oldest), now)
+
+def collect_orders(order_ids=(), qr_codes=(), scanned_at=None):
+    """Mark pending orders collected with one conditional UPDATE.
+    scanned_at maps order ids / QR codes to when a gate scanned them offline; the rest are
+    stamped now. Returns a result per requested order: collected, already_collected or not_found"""
+    order_ids = {int(order_id) for order_id in order_ids}
+    qr_codes = set(qr_codes)
+    scanned_at = scanned_at or {}
+    batch = uuid.uuid4().hex
+    match = db.or_(Order.id.in_(order_ids), Order.qr_code.in_(qr_codes))
+    
+    collected_at = datetime.now(timezone.utc)
+    by_id = {key: moment for key, moment in scanned_at.items() if isinstance(key, int)}
+    by_code = {key: moment for key, moment in scanned_at.items() if isinstance(key, str)}
+    if by_code:
+        collected_at = db.case(by_code, value=Order.qr_code, else_=collected_at)
+    if by_id:
+        collected_at = db.case(by_id, value=Order.id, else_=collected_at)
+    
+    # Only one caller can move an order out of 'pending', the batch token records who did
+    won = Order.query.filter(match, Order.status == 'pending').update(
+        {'status': 'collected', 'collected_at': collected_at, 'collected_batch': batch},
+        synchronize_session=False
+    )
+    if not qr_codes and won == len(order_ids):
+        # Every requested id was pending, nothing to report back
+        db.session.commit()
+        return [{'order_id': order_id, 'result': 'collected'} for order_id in sorted(order_ids)]
+    
+    rows = db.session.query(Order.id, Order.qr_code, Order.status, Order.collected_at, Order.collected_batch).filter(match).all()
+    db.session.commit()
+    
+    results = []
+    for row in rows:
+        results.append({
+            'order_id': row.id,
+            'qr_code': row.qr_code,
+            'result': 'collected' if row.collected_batch == batch else 'already_collected',
+            'collected_at': row.collected_at.isoformat() if row.collected_at else None
+        })
+    found_ids = {row.id for row in rows}
+    found_codes = {row.qr_code for row in rows}
+    results.extend({'order_id': order_id, 'result': 'not_found'} for order_id in order_ids - found_ids)
+    results.extend({'qr_code': code, 'result': 'not_found'} for code in qr_codes - found_codes)
+    return results
+
+# Gate manifests are signed with Ed25519 so gate devices only ever hold the public key
+_gate_manifest_key = None
+
+def gate_manifest_key():
+    """The Ed25519 signing key from GATE_MANIFEST_SIGNING_KEY (base64 of the 32-byte seed), or None"""
+    global _gate_manifest_key
+    if _gate_manifest_key is None and Ed25519PrivateKey and app.config['GATE_MANIFEST_SIGNING_KEY']:
+        _gate_manifest_key = Ed25519PrivateKey.from_private_bytes(
+            base64.b64decode(app.config['GATE_MANIFEST_SIGNING_KEY'])
+        )
+    return _gate_manifest_key
+
+def gate_public_key_bytes(private_key):
+    return private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+@app.cli.command('generate-gate-key')
+def generate_gate_key_command():
+    """Print a new gate manifest key pair: the private key goes in GATE_MANIFEST_SIGNING_KEY, the public key on gates"""
+    if not Ed25519PrivateKey:
+        raise click.ClickException('Install the cryptography package first')
+    private_key = Ed25519PrivateKey.generate()
+    seed = private_key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                     serialization.NoEncryption())
+    click.echo(f'GATE_MANIFEST_SIGNING_KEY={base64.b64encode(seed).decode()}')
+    click.echo(f'Gate public key: {base64.b64encode(gate_public_key_bytes(private_key)).decode()}')
+
+@app.route('/api/gate-manifest/public-key')
+@login_required
+def gate_manifest_public_key():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    private_key = gate_manifest_key()
+    if private_key is None:
+        return jsonify({'error': 'Gate manifest signing is not configured'}), 503
+    return jsonify({'algorithm': 'Ed25519', 'public_key': base64.b64encode(gate_public_key_bytes(private_key)).decode()})
+
+@app.route('/api/gate-manifest/<int:temple_id>')
+@login_required
+def gate_manifest(temple_id):
+    """Signed list of the day's redeemable QR codes for offline gate devices"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    private_key = gate_manifest_key()
+    if private_key is None:
+        return jsonify({'error': 'Gate manifest signing is not configured'}), 503
+    
+    date_str = request.args.get('date') or local_today().isoformat()
+    try:
+        visit_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    
+    rows = db.session.query(
+        Order.qr_code, Order.id, Order.booking_id, Order.total_amount,
+        Booking.persons, Booking.time_slot, User.name
+    ).join(Booking, Order.booking_id == Booking.id).join(User, Booking.user_id == User.id).filter(
+        Booking.temple_id == temple_id,
+        Booking.date == visit_date,
+        Booking.payment_status == 'completed',
+        Order.status == 'pending'
+    ).order_by(Order.qr_code).all()
+    
+    # Sorted by code so devices can binary search it
+    manifest = {
+        'temple_id': temple_id,
+        'date': visit_date.isoformat(),
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'fields': ['qr_code', 'order_id', 'booking_id', 'services_amount', 'persons', 'time_slot', 'user_name'],
+        'orders': [list(row) for row in rows]
+    }
+    body = json.dumps(manifest, separators=(',', ':')).encode()
+    # Signature covers the uncompressed JSON
+    signature = base64.b64encode(private_key.sign(body)).decode()
+    
+    response = app.response_class(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] > 0:
+        response.set_data(gzip.compress(body))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['X-Manifest-Signature'] = signature
+    response.headers['X-Manifest-Count'] = str(len(rows))
+    return response
+
+@app.route('/api/collect-orders', methods=['POST'])
+@login_required
+def collect_orders_bulk():
+    """Sync collections recorded offline by a gate device"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.json or {}
+    order_ids = list(data.get('order_ids') or [])
+    qr_codes = list(data.get('qr_codes') or [])
+    scans = data.get('scans') or []
+    if not order_ids and not qr_codes and not scans:
+        return jsonify({'error': 'order_ids, qr_codes or scans required'}), 400
+    if len(order_ids) + len(qr_codes) + len(scans) > app.config['COLLECT_ORDERS_MAX_SIZE']:
+        return jsonify({'error': f"At most {app.config['COLLECT_ORDERS_MAX_SIZE']} orders per request"}), 400
+    
+    # scans: [{"order_id" or "qr_code", "scanned_at"}] keep the time each order was scanned at the gate
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    scanned_at = {}
+    try:
+        for scan in scans:
+            if scan.get('qr_code'):
+                key = str(scan['qr_code'])
+                qr_codes.append(key)
+            else:
+                key = int(scan['order_id'])
+                order_ids.append(key)
+            scanned_at[key] = parse_scanned_at(scan.get('scanned_at'), now)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Each scan needs an order_id or qr_code and an ISO 8601 scanned_at'}), 400
+    
+    try:
+        results = collect_orders(order_ids, qr_codes, scanned_at)
+    except (TypeError, ValueError):
+        db.session.rollback()
+        return jsonify({'error': 'Invalid order id'}), 400
+    
+    return jsonify({
+        'success': True,
+        'collected': sum(1 for r in results if r['result'] == 'collected'),
+        'conflicts': [r for r in results if r['result'] != 'collected'],
+        'results': results
+    })
+
+def gate_entry_error(visit_date, payment_status, status):
+    """Why an order can't be redeemed at the gate right now, or None.
+    Same rules as the gate manifest: paid, still pending, and only on the visit day"""
+    if visit_date < local_today():
+        return 'QR code has expired'
+    if visit_date > local_today():
+        return f"QR code is valid on {visit_date.strftime('%d %B %Y')}"
+    if payment_status != 'completed':
+        return 'Booking is not paid'
+    if status == 'collected':
+        return 'Order already collected'
+    return None
+
 @app.route('/api/verify-qr', methods=['POST'])
 @login_required
+@query_budget(4)
 def verify_qr():
     if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
@@ -1033,36 +3218,45 @@ def verify_qr():
     
     print(f'Verifying QR code: {qr_code}')  # Debug log
     
-    order = Order.query.filter_by(qr_code=qr_code).first()
+    # Signed tokens from the QR image carry the order details; one query fetches what can
+    # change after issue (order and payment status) and the pilgrim's name
+    if '.' in qr_code:
+        payload = read_qr_token(qr_code)
+        if payload is None:
+            return jsonify({'error': 'Invalid QR code'}), 404
+        
+        row = db.session.query(Order.status, Booking.payment_status, User.name).join(
+            Booking, Order.booking_id == Booking.id
+        ).join(User, Booking.user_id == User.id).filter(Order.id == payload['o']).first()
+        if row is None:
+            return jsonify({'error': 'Invalid QR code'}), 404
+        status, payment_status, user_name = row
+        error = gate_entry_error(datetime.strptime(payload['d'], '%Y-%m-%d').date(), payment_status, status)
+        if error:
+            return jsonify({'error': error}), 400
+        order_items = () if qr_token_has_names(payload) else OrderItem.query.filter_by(order_id=payload['o']).all()
+        return jsonify(describe_qr_token(payload, status, user_name, order_items))
+    
+    # New-format codes carry a check character, so typos are rejected without a DB hit
+    if len(qr_code) == len('QR') + IdGenerator.WIDTH + 1 and not has_valid_check_char(qr_code, 'QR'):
+        return jsonify({'error': 'Invalid QR code'}), 404
+    
+    order = Order.query.filter_by(qr_code=qr_code).options(
+        joinedload(Order.booking).joinedload(Booking.user),
+        joinedload(Order.booking).joinedload(Booking.temple),
+        selectinload(Order.items)
+    ).first()
     
     if not order:
         print(f'QR code not found: {qr_code}')  # Debug log
         return jsonify({'error': 'Invalid QR code'}), 404
     
-    if order.status == 'collected':
-        return jsonify({'error': 'Order already collected'}), 400
+    error = gate_entry_error(order.booking.date, order.booking.payment_status, order.status)
+    if error:
+        return jsonify({'error': error}), 400
     
     # Get order details
-    prasads = []
-    poojas = []
-    
-    for item in order.items:
-        if item.item_type == 'prasad':
-            prasad = Prasad.query.get(item.item_id)
-            if prasad:
-                prasads.append({
-                    'name': prasad.name,
-                    'quantity': item.quantity,
-                    'price': item.price
-                })
-        elif item.item_type == 'pooja':
-            pooja = Pooja.query.get(item.item_id)
-            if pooja:
-                poojas.append({
-                    'name': pooja.name,
-                    'duration': pooja.duration,
-                    'price': item.price
-                })
+    prasads, poojas = describe_order_items(order)
     
     print(f'QR verification successful for order: {order.id}')  # Debug log
     
@@ -1094,16 +3288,37 @@ def collect_order():
     if current_user.role != 'admin':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    order_id = request.json.get('order_id')
-    order = Order.query.get(order_id)
+    data = request.json or {}
     
-    if not order:
+    # Several gates can collect in one request by sending a list
+    if 'order_ids' in data:
+        try:
+            results = collect_orders(data['order_ids'] or [])
+        except (TypeError, ValueError):
+            db.session.rollback()
+            return jsonify({'error': 'Invalid order id'}), 400
+        return jsonify({
+            'success': True,
+            'collected': sum(1 for r in results if r['result'] == 'collected'),
+            'results': results
+        })
+    
+    try:
+        order_id = int(data.get('order_id'))
+    except (TypeError, ValueError):
         return jsonify({'error': 'Order not found'}), 404
     
-    order.status = 'collected'
+    # Conditional update: only the first gate to scan the order wins
+    won = Order.query.filter(Order.id == order_id, Order.status == 'pending').update(
+        {'status': 'collected', 'collected_at': datetime.now(timezone.utc)}, synchronize_session=False
+    )
     db.session.commit()
     
-    return jsonify({'success': True, 'message': 'Order marked as collected'})
+    if won:
+        return jsonify({'success': True, 'collected': True, 'message': 'Order marked as collected'})
+    if db.session.query(Order.id).filter(Order.id == order_id).first() is None:
+        return jsonify({'error': 'Order not found'}), 404
+    return jsonify({'success': False, 'collected': False, 'error': 'Order already collected'}), 409
 
 @app.route('/pilgrim-dashboard')
 @login_required
@@ -1112,36 +3327,40 @@ def pilgrim_dashboard():
         return redirect(url_for('admin'))
     return render_template('pilgrim_dashboard.html')
 
+def order_stats():
+    """Today's order revenue and pending/collected order counts"""
+    today_revenue = db.session.query(db.func.sum(Order.total_amount)).join(Booking).filter(
+        created_within(Booking.created_at, day_bounds(local_today()))
+    ).scalar() or 0
+    pending_orders = Order.query.filter_by(status='pending').count()
+    collected_orders = Order.query.filter_by(status='collected').count()
+    return today_revenue, pending_orders, collected_orders
+
 @app.route('/temple-dashboard')
 @login_required
+@query_budget(10)
 def temple_dashboard():
     if current_user.role != 'admin':
         return redirect(url_for('index'))
     
     temples = Temple.query.filter_by(is_active=True).all()
-    today = datetime.now().date()
+    today = day_bounds(local_today())
     
-    # Today's bookings
+    # Today's bookings with everything the template touches: user, temple and orders
     today_bookings = Booking.query.filter(
-        db.func.date(Booking.created_at) == today
-    ).join(Temple).join(User).all()
-    
-    # Today's orders with QR codes
-    today_orders = Order.query.join(Booking).filter(
-        db.func.date(Booking.created_at) == today
-    ).all()
+        created_within(Booking.created_at, today)
+    ).options(
+        joinedload(Booking.user), joinedload(Booking.temple), selectinload(Booking.orders)
+    ).order_by(Booking.created_at.desc()).all()
     
     # Revenue stats
-    today_revenue = db.session.query(db.func.sum(Order.total_amount)).join(Booking).filter(
-        db.func.date(Booking.created_at) == today
-    ).scalar() or 0
-    
-    pending_orders = Order.query.filter_by(status='pending').count()
-    collected_orders = Order.query.filter_by(status='collected').count()
+    today_revenue, pending_orders, collected_orders = analytics_cache.get_or_compute(
+        ('order_stats', local_today()), order_stats
+    )
     
     return render_template('temple_dashboard.html', 
                          temples=temples, today_bookings=today_bookings, 
-                         today_orders=today_orders, today_revenue=today_revenue,
+                         today_revenue=today_revenue,
                          pending_orders=pending_orders, collected_orders=collected_orders)
 
 @app.route('/camera-scanner')
@@ -1165,6 +3384,7 @@ def payment_page(booking_id):
 
 @app.route('/api/process-payment', methods=['POST'])
 @login_required
+@idempotent
 def process_payment():
     data = request.json
     booking_id = data.get('booking_id')
@@ -1173,31 +3393,40 @@ def process_payment():
     if booking.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
+    if booking.payment_status == 'completed':
+        return jsonify({
+            'success': True,
+            'transaction_id': booking.transaction_id,
+            'message': 'Booking already paid'
+        })
+    
     # Dummy payment gateway simulation
-    import random
-    payment_success = random.choice([True, True, True, True, True, False])  # 83% success rate
+    payment_success = random.random() >= app.config['PAYMENT_FAILURE_RATE']
     
     if payment_success:
         # Generate transaction ID
         transaction_id = f'TXN{random.randint(100000, 999999)}'
         
-        # Update booking status
-        booking.payment_status = 'completed'
-        booking.status = 'confirmed'
-        booking.transaction_id = transaction_id
-        db.session.commit()
+        # Conditional update: only one concurrent payment for a booking can flip it to completed
+        won = Booking.query.filter(Booking.id == booking.id, Booking.payment_status != 'completed').update(
+            {'payment_status': 'completed', 'status': 'confirmed', 'transaction_id': transaction_id},
+            synchronize_session=False
+        )
+        if not won:
+            db.session.rollback()
+            db.session.refresh(booking)
+            return jsonify({
+                'success': True,
+                'transaction_id': booking.transaction_id,
+                'message': 'Booking already paid'
+            })
         
-        # Send confirmation email only after successful payment
-        try:
-            qr_code = None
-            order_amount = 0
-            for order in booking.orders:
-                qr_code = order.qr_code
-                order_amount = order.total_amount
-                break
-            send_booking_confirmation_email(booking, qr_code, order_amount)
-        except Exception as e:
-            print(f'Email sending failed: {e}')
+        record_paid_booking(booking)
+        
+        # Confirmation email is queued in the same transaction and sent by the outbox workers
+        queue_email(current_user.email, kind='booking_confirmation', booking_id=booking.id)
+        db.session.commit()
+        email_outbox.wake()
         
         return jsonify({
             'success': True,
@@ -1222,6 +3451,13 @@ def payment_receipt(booking_id):
     
     return render_template('payment_receipt.html', booking=booking)
 
+def service_revenue_totals():
+    """Total order revenue and the prasad/pooja split"""
+    total_revenue = db.session.query(db.func.sum(Order.total_amount)).scalar() or 0
+    prasad_revenue = db.session.query(db.func.sum(OrderItem.price)).filter(OrderItem.item_type == 'prasad').scalar() or 0
+    pooja_revenue = db.session.query(db.func.sum(OrderItem.price)).filter(OrderItem.item_type == 'pooja').scalar() or 0
+    return total_revenue, prasad_revenue, pooja_revenue
+
 @app.route('/admin/prasad-pooja')
 @login_required
 def manage_prasad_pooja():
@@ -1233,9 +3469,7 @@ def manage_prasad_pooja():
     poojas = Pooja.query.join(Temple).all()
     
     # Revenue statistics
-    total_revenue = db.session.query(db.func.sum(Order.total_amount)).scalar() or 0
-    prasad_revenue = db.session.query(db.func.sum(OrderItem.price)).filter(OrderItem.item_type == 'prasad').scalar() or 0
-    pooja_revenue = db.session.query(db.func.sum(OrderItem.price)).filter(OrderItem.item_type == 'pooja').scalar() or 0
+    total_revenue, prasad_revenue, pooja_revenue = analytics_cache.get_or_compute(('service_revenue',), service_revenue_totals)
     
     return render_template('manage_prasad_pooja.html', 
                          temples=temples, prasads=prasads, poojas=poojas,
@@ -1256,6 +3490,8 @@ def manage_prasad_api():
         )
         db.session.add(prasad)
         db.session.commit()
+        invalidate_temple_catalog(prasad.temple_id)
+        search_index.index_item('prasad', prasad)
         return jsonify({'success': True, 'id': prasad.id})
     
     elif request.method == 'PUT':
@@ -1266,6 +3502,8 @@ def manage_prasad_api():
             prasad.price = float(data['price'])
             prasad.is_available = data.get('is_available', True)
             db.session.commit()
+            invalidate_temple_catalog(prasad.temple_id)
+            search_index.index_item('prasad', prasad)
             return jsonify({'success': True})
         return jsonify({'error': 'Prasad not found'}), 404
     
@@ -1273,8 +3511,11 @@ def manage_prasad_api():
         prasad_id = request.json.get('id')
         prasad = Prasad.query.get(prasad_id)
         if prasad:
+            temple_id, item_id = prasad.temple_id, prasad.id
             db.session.delete(prasad)
             db.session.commit()
+            invalidate_temple_catalog(temple_id)
+            search_index.remove('prasad', item_id)
             return jsonify({'success': True})
         return jsonify({'error': 'Prasad not found'}), 404
 
@@ -1294,6 +3535,8 @@ def manage_pooja_api():
         )
         db.session.add(pooja)
         db.session.commit()
+        invalidate_temple_catalog(pooja.temple_id)
+        search_index.index_item('pooja', pooja)
         return jsonify({'success': True, 'id': pooja.id})
     
     elif request.method == 'PUT':
@@ -1305,6 +3548,8 @@ def manage_pooja_api():
             pooja.duration = int(data['duration'])
             pooja.is_available = data.get('is_available', True)
             db.session.commit()
+            invalidate_temple_catalog(pooja.temple_id)
+            search_index.index_item('pooja', pooja)
             return jsonify({'success': True})
         return jsonify({'error': 'Pooja not found'}), 404
     
@@ -1312,44 +3557,53 @@ def manage_pooja_api():
         pooja_id = request.json.get('id')
         pooja = Pooja.query.get(pooja_id)
         if pooja:
+            temple_id, item_id = pooja.temple_id, pooja.id
             db.session.delete(pooja)
             db.session.commit()
+            invalidate_temple_catalog(temple_id)
+            search_index.remove('pooja', item_id)
             return jsonify({'success': True})
         return jsonify({'error': 'Pooja not found'}), 404
 
-@app.route('/api/revenue-stats')
-@login_required
-def revenue_stats():
-    if current_user.role != 'admin':
-        return jsonify({'error': 'Unauthorized'}), 403
-    
+def revenue_stats_data():
+    """Today's and this month's revenue plus today's bookings"""
     # Daily revenue
-    today = datetime.now().date()
+    today = local_today()
     daily_revenue = db.session.query(db.func.sum(Order.total_amount)).filter(
-        db.func.date(Order.created_at) == today
+        created_within(Order.created_at, day_bounds(today))
     ).scalar() or 0
     
     # Monthly revenue
-    month_start = today.replace(day=1)
     monthly_revenue = db.session.query(db.func.sum(Order.total_amount)).filter(
-        Order.created_at >= month_start
+        created_within(Order.created_at, month_bounds(today))
     ).scalar() or 0
     
     # Total bookings today
     daily_bookings = Booking.query.filter(
-        db.func.date(Booking.created_at) == today
+        created_within(Booking.created_at, day_bounds(today))
     ).count()
     
-    return jsonify({
+    return {
         'daily_revenue': daily_revenue,
         'monthly_revenue': monthly_revenue,
         'daily_bookings': daily_bookings
-    })
+    }
+
+@app.route('/api/revenue-stats')
+@login_required
+def revenue_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    return jsonify(analytics_cache.get_or_compute(('revenue_stats', local_today()), revenue_stats_data))
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
         
+        # Resolve the CONVERT_TZ zone before the rollup seeding below can swallow a failure
+        print(f"Grouping analytics days with time zone {sql_time_zone()}")
+        
         # Database migrations
         try:
             result = db.session.execute(text("SHOW COLUMNS FROM crowd LIKE 'temple_id'"))
@@ -1430,6 +3684,48 @@ if __name__ == '__main__':
                 """))
                 db.session.commit()
                 print("Added prasad and pooja tables")
+            
+            # Add collection tracking columns to order table
+            result = db.session.execute(text("SHOW COLUMNS FROM `order` LIKE 'collected_at'"))
+            if not result.fetchone():
+                db.session.execute(text("ALTER TABLE `order` ADD COLUMN collected_at DATETIME"))
+                db.session.execute(text("ALTER TABLE `order` ADD COLUMN collected_batch VARCHAR(32)"))
+                db.session.commit()
+                print("Added collection columns to order table")
+            
+            # Snapshot catalog details on order lines and backfill existing rows once
+            result = db.session.execute(text("SHOW COLUMNS FROM order_item LIKE 'name'"))
+            if not result.fetchone():
+                db.session.execute(text("ALTER TABLE order_item ADD COLUMN name VARCHAR(100)"))
+                db.session.execute(text("ALTER TABLE order_item ADD COLUMN unit_price FLOAT"))
+                db.session.execute(text("ALTER TABLE order_item ADD COLUMN duration INT"))
+                db.session.execute(text("""
+                    UPDATE order_item oi JOIN prasad p ON oi.item_id = p.id
+                    SET oi.name = p.name, oi.unit_price = oi.price / NULLIF(oi.quantity, 0)
+                    WHERE oi.item_type = 'prasad'
+                """))
+                db.session.execute(text("""
+                    UPDATE order_item oi JOIN pooja p ON oi.item_id = p.id
+                    SET oi.name = p.name, oi.unit_price = oi.price / NULLIF(oi.quantity, 0), oi.duration = p.duration
+                    WHERE oi.item_type = 'pooja'
+                """))
+                db.session.commit()
+                print("Added and backfilled order item snapshot columns")
+            
+            # Indexes for the date-range filters on existing tables
+            for model in (Booking, Order):
+                for idx in model.__table__.indexes:
+                    exists = db.session.execute(text(f"SHOW INDEX FROM `{model.__tablename__}` WHERE Key_name = :name"),
+                                                {'name': idx.name}).fetchone()
+                    if not exists:
+                        idx.create(db.engine)
+                        print(f"Added index {idx.name}")
+            
+            # Seed the daily stats rollup from existing bookings the first time
+            first_booking_at = db.session.query(db.func.min(Booking.created_at)).scalar()
+            if first_booking_at and not DailyTempleStats.query.first():
+                rebuild_daily_stats(local_date(first_booking_at), local_today() + timedelta(days=1))
+                print("Seeded daily temple stats")
         except Exception as e:
             print(f"Migration handled: {e}")
         
@@ -1438,7 +3734,7 @@ if __name__ == '__main__':
             admin = User(
                 name='Admin',
                 email='admin@temple.com',
-                password_hash=generate_password_hash('admin123'),
+                password_hash=generate_password_hash('admin123', app.config['PASSWORD_HASH_METHOD']),
                 role='admin'
             )
             db.session.add(admin)
@@ -1564,6 +3860,12 @@ if __name__ == '__main__':
                 else:
                     print('Not enough temples found to add prasad/pooja data')
         
+        # Temples created outside add_temple (seed data, SQL imports) get their crowd rows here
+        prepare_process()
+        
         os.makedirs('uploads', exist_ok=True)
     
+    # Drain anything left in the email outbox from a previous run
+    email_outbox.start()
+    
     socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -121,6 +121,8 @@ CREATE TABLE `order` (
     total_amount FLOAT NOT NULL,
     qr_code VARCHAR(100) UNIQUE NOT NULL,
     status VARCHAR(20) DEFAULT 'pending',
+    collected_at DATETIME,
+    collected_batch VARCHAR(32),
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (booking_id) REFERENCES booking(id) ON DELETE CASCADE,
     INDEX idx_booking_id (booking_id),
@@ -138,12 +140,111 @@ CREATE TABLE order_item (
     item_id INT NOT NULL,
     quantity INT DEFAULT 1,
     price FLOAT NOT NULL,
+    name VARCHAR(100),
+    unit_price FLOAT,
+    duration INT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (order_id) REFERENCES `order`(id) ON DELETE CASCADE,
     INDEX idx_order_id (order_id),
     INDEX idx_item_type (item_type)
 );
 
+-- =====================================================
+-- 9. EMAIL_OUTBOX TABLE - Emails waiting for the background sender
+-- =====================================================
+CREATE TABLE email_outbox (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(30) NOT NULL DEFAULT 'plain',
+    booking_id INT,
+    recipient VARCHAR(100) NOT NULL,
+    subject VARCHAR(200),
+    body TEXT,
+    html TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    claim_token VARCHAR(32),
+    claimed_at DATETIME,
+    last_error VARCHAR(500),
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (booking_id) REFERENCES booking(id) ON DELETE CASCADE,
+    INDEX idx_outbox_status_next (status, next_attempt_at),
+    INDEX idx_claim_token (claim_token)
+);
+
+-- =====================================================
+-- 10. DAILY_TEMPLE_STATS TABLE - Per-day booking rollup for analytics
+-- =====================================================
+CREATE TABLE daily_temple_stats (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    day DATE NOT NULL,
+    temple_id INT NOT NULL,
+    bookings INT NOT NULL DEFAULT 0,
+    paid_bookings INT NOT NULL DEFAULT 0,
+    visitors INT NOT NULL DEFAULT 0,
+    revenue FLOAT NOT NULL DEFAULT 0,
+    prasad_revenue FLOAT NOT NULL DEFAULT 0,
+    pooja_revenue FLOAT NOT NULL DEFAULT 0,
+    FOREIGN KEY (temple_id) REFERENCES temple(id) ON DELETE CASCADE,
+    UNIQUE KEY uq_daily_temple_stats_day_temple (day, temple_id)
+);
+
+-- =====================================================
+-- 11. ID_WORKER_LEASE TABLE - Worker ids leased by running processes
+-- =====================================================
+CREATE TABLE id_worker_lease (
+    worker_id INT PRIMARY KEY,
+    holder VARCHAR(32) NOT NULL,
+    renewed_at DATETIME NOT NULL
+);
+
+-- =====================================================
+-- 12. CATALOG_CHANGE TABLE - Temple catalog change log, highest id is the catalog version
+-- =====================================================
+CREATE TABLE catalog_change (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    temple_id INT,
+    changed_at DATETIME NOT NULL
+);
+
+-- =====================================================
+-- 13. IDEMPOTENCY_KEY TABLE - Idempotency-Key claims and stored responses
+-- =====================================================
+CREATE TABLE idempotency_key (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    endpoint VARCHAR(100) NOT NULL,
+    request_key VARCHAR(255) NOT NULL,
+    fingerprint VARCHAR(64) NOT NULL,
+    state VARCHAR(10) NOT NULL DEFAULT 'pending',
+    status_code INT,
+    mimetype VARCHAR(100),
+    body MEDIUMBLOB,
+    created_at DATETIME NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES user(id) ON DELETE CASCADE,
+    UNIQUE KEY uq_idempotency_user_endpoint_key (user_id, endpoint, request_key),
+    INDEX idx_idempotency_created (created_at)
+);
+
+-- =====================================================
+-- 14. USER_CHANGE TABLE - Recent user edits, read by every process to refresh its user cache
+-- =====================================================
+CREATE TABLE user_change (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    changed_at DATETIME NOT NULL,
+    INDEX ix_user_change_changed_at (changed_at)
+);
+
+-- =====================================================
+-- 15. CROWD_ALERT TABLE - Last high-crowd alert per temple, for throttling
+-- =====================================================
+CREATE TABLE crowd_alert (
+    temple_id INT PRIMARY KEY,
+    last_sent_at DATETIME NOT NULL,
+    FOREIGN KEY (temple_id) REFERENCES temple(id) ON DELETE CASCADE
+);
+
 -- =====================================================
 -- SAMPLE DATA INSERTION
 -- =====================================================
@@ -193,6 +294,12 @@ CREATE INDEX idx_booking_date_temple ON booking(date, temple_id);
 CREATE INDEX idx_order_created_status ON `order`(created_at, status);
 CREATE INDEX idx_crowd_temple_updated ON crowd(temple_id, updated_at);
 CREATE INDEX idx_user_role_created ON user(role, created_at);
+CREATE INDEX idx_booking_created ON booking(created_at);
+CREATE INDEX idx_booking_payment_created ON booking(payment_status, created_at);
+CREATE INDEX idx_booking_temple_created ON booking(temple_id, created_at);
+CREATE INDEX idx_booking_user_created ON booking(user_id, created_at);
+CREATE INDEX idx_order_created ON `order`(created_at);
+CREATE INDEX idx_order_status ON `order`(status);
 
 -- =====================================================
 -- DATABASE VIEWS FOR ANALYTICS
@@ -295,6 +402,8 @@ TABLES CREATED:
 6. pooja - Special religious services
 7. order - QR code orders for services
 8. order_item - Individual items in orders
+9. email_outbox - Queued emails for the background sender
+10. daily_temple_stats - Daily per-temple booking rollup
 
 FEATURES SUPPORTED:
 - User registration and authentication
@@ -2,6 +2,10 @@ import os
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'temple-management-secret-key'
+    # HMAC key for the signed tokens encoded in booking QR images; required and separate from SECRET_KEY
+    QR_TOKEN_KEY = os.environ.get('QR_TOKEN_KEY')
+    # Ed25519 private key (base64 of the 32-byte seed) for gate manifests; no fallback, see `flask generate-gate-key`
+    GATE_MANIFEST_SIGNING_KEY = os.environ.get('GATE_MANIFEST_SIGNING_KEY')
     
     # MySQL Configuration
     MYSQL_HOST = os.environ.get('MYSQL_HOST') or 'sql12.freesqldatabase.com'
@@ -12,10 +16,100 @@ class Config:
     SQLALCHEMY_DATABASE_URI = f'mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DB}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Timezone that defines calendar days for dashboards and stats; timestamps are stored in UTC
+    APP_TIMEZONE = os.environ.get('APP_TIMEZONE') or 'Asia/Kolkata'
+    
     # Mail Configuration
-    MAIL_SERVER = 'smtp.gmail.com'
-    MAIL_PORT = 587
-    MAIL_USE_TLS = True
+    MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
+    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
+    MAIL_USE_TLS = (os.environ.get('MAIL_USE_TLS') or 'true').lower() == 'true'
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME') or 'vedanthh46@gmail.com'
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD') or 'zcfrdrpgxalygkrp'
-    MAIL_DEFAULT_SENDER = 'piligrim@temple.com'
\ No newline at end of file
+    MAIL_DEFAULT_SENDER = 'piligrim@temple.com'
+    # Flask-Mail skips the SMTP call when true (used by the in-process tests)
+    MAIL_SUPPRESS_SEND = (os.environ.get('MAIL_SUPPRESS_SEND') or 'false').lower() == 'true'
+    
+    # Share of payments the simulated gateway declines; tests set it to 0
+    PAYMENT_FAILURE_RATE = float(os.environ.get('PAYMENT_FAILURE_RATE') or 1 / 6)
+    
+    # Idempotency-Key replay window for /api/book and /api/process-payment
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL') or 24 * 60 * 60)
+    
+    # Worker id (0-1023) for confirmation/QR id generation; must differ per running process.
+    # Leave unset to lease a free id from the id_worker_lease table
+    ID_WORKER_ID = os.environ.get('ID_WORKER_ID')
+    
+    # Largest batch accepted by /api/bookings/bulk
+    BULK_BOOKING_MAX_SIZE = int(os.environ.get('BULK_BOOKING_MAX_SIZE') or 200)
+    
+    # Email outbox workers
+    EMAIL_OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS') or 2)
+    EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE') or 50)
+    EMAIL_OUTBOX_POLL_INTERVAL = int(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL') or 5)
+    EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS') or 6)
+    EMAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_RETRY_DELAY') or 30)  # doubles per attempt
+    EMAIL_SMTP_IDLE_TIMEOUT = int(os.environ.get('EMAIL_SMTP_IDLE_TIMEOUT') or 60)
+    
+    # High-crowd alerts: minimum seconds between alerts per temple, how far ahead
+    # bookings count as upcoming, and recipients fetched per chunk
+    CROWD_ALERT_COOLDOWN = int(os.environ.get('CROWD_ALERT_COOLDOWN') or 30 * 60)
+    CROWD_ALERT_WINDOW_DAYS = int(os.environ.get('CROWD_ALERT_WINDOW_DAYS') or 2)
+    CROWD_ALERT_CHUNK_SIZE = int(os.environ.get('CROWD_ALERT_CHUNK_SIZE') or 500)
+    
+    # Rendered QR images: on-disk cache directory and in-memory LRU size
+    QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR') or 'qr_cache'
+    QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE') or 2048)
+    
+    # Largest batch accepted by /api/collect-orders
+    COLLECT_ORDERS_MAX_SIZE = int(os.environ.get('COLLECT_ORDERS_MAX_SIZE') or 1000)
+    # Oldest scanned_at accepted from a gate device, in hours; older (and future) times are clamped
+    COLLECT_SCAN_MAX_AGE_HOURS = int(os.environ.get('COLLECT_SCAN_MAX_AGE_HOURS') or 48)
+    
+    # Seconds admin dashboard/analytics results are reused before recomputing; also how stale they may be
+    ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL') or 60)
+    
+    # Rows fetched per server-side cursor batch by /admin/bookings/export
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+    
+    # Rows per page on the booking lists (admin and my bookings)
+    BOOKINGS_PAGE_SIZE = int(os.environ.get('BOOKINGS_PAGE_SIZE') or 20)
+    
+    # Raise instead of logging when a view exceeds its @query_budget (set in tests)
+    QUERY_BUDGET_STRICT = (os.environ.get('QUERY_BUDGET_STRICT') or 'false').lower() == 'true'
+    
+    # Upper bound on how long a rendered temple page fragment is reused; catalog edits clear it sooner
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 3600)
+    
+    # Catalog changes remembered for /api/temples?since= deltas; older clients get the full list
+    CATALOG_CHANGE_LOG_SIZE = int(os.environ.get('CATALOG_CHANGE_LOG_SIZE') or 1000)
+    
+    # How often each process checks the shared catalog version for changes made by other processes
+    CATALOG_SYNC_SECONDS = float(os.environ.get('CATALOG_SYNC_SECONDS') or 1)
+    
+    # Grid cell size (degrees) for the nearby-temples index and the largest radius it serves
+    NEARBY_CELL_DEGREES = float(os.environ.get('NEARBY_CELL_DEGREES') or 0.5)
+    NEARBY_MAX_RADIUS_KM = float(os.environ.get('NEARBY_MAX_RADIUS_KM') or 500)
+    
+    # Most vocabulary words a typeahead prefix in /api/search expands to
+    SEARCH_MAX_EXPANSIONS = int(os.environ.get('SEARCH_MAX_EXPANSIONS') or 50)
+    
+    # Seconds and entries for the logged-in user cache behind load_user
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 300)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    # How often each process checks user_change for role/profile edits made by other processes
+    USER_SYNC_SECONDS = float(os.environ.get('USER_SYNC_SECONDS') or 2)
+    
+    # Password hashing: werkzeug method string including its cost parameters. Logins with a
+    # hash made under a different method/cost are rehashed transparently. WORKERS hashes run at
+    # once, BACKLOG more may wait up to TIMEOUT seconds; beyond that login/register answer 503
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 4)
+    PASSWORD_HASH_BACKLOG = int(os.environ.get('PASSWORD_HASH_BACKLOG') or 32)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 2)
+    
+    # Token buckets on login/register: attempts per minute and burst, per client IP and per account.
+    # Buckets are per process: with N app processes the effective limit is N times these
+    AUTH_RATE_PER_IP = float(os.environ.get('AUTH_RATE_PER_IP') or 20)
+    AUTH_BURST_PER_IP = int(os.environ.get('AUTH_BURST_PER_IP') or 40)
+    AUTH_RATE_PER_ACCOUNT = float(os.environ.get('AUTH_RATE_PER_ACCOUNT') or 5)
+    AUTH_BURST_PER_ACCOUNT = int(os.environ.get('AUTH_BURST_PER_ACCOUNT') or 10)
\ No newline at end of file
@@ -4,6 +4,8 @@ Test script for Enhanced Temple Management System
 """
 import requests
 import json
+import os
+import secrets
 
 BASE_URL = 'http://localhost:5000'
 
@@ -59,6 +61,221 @@ def test_web_pages():
         except Exception as e:
             print(f"✗ Page {page} error: {e}")
 
+_isolated_app = None
+
+def isolated_app():
+    """The app module bound to a throwaway MySQL schema, with mail suppressed.
+    Name the schema in TEST_MYSQL_DB (same server and credentials as MYSQL_*); its tables
+    are dropped and recreated once per run. Returns None when TEST_MYSQL_DB isn't set"""
+    global _isolated_app
+    if _isolated_app is not None:
+        return _isolated_app
+    schema = os.environ.get('TEST_MYSQL_DB')
+    if not schema:
+        return None
+    if schema == os.environ.get('MYSQL_DB'):
+        raise RuntimeError('TEST_MYSQL_DB must not be the application database, its tables are dropped')
+    
+    # Config is read when app is imported, so point it at the test schema first
+    os.environ['MYSQL_DB'] = schema
+    os.environ['MAIL_SUPPRESS_SEND'] = 'true'
+    os.environ.setdefault('QR_TOKEN_KEY', secrets.token_urlsafe(32))
+    import app as app_module
+    if app_module.app.config['MYSQL_DB'] != schema:
+        raise RuntimeError('app was imported before isolated_app() and is bound to another database')
+    
+    app_module.app.config['TESTING'] = True
+    app_module.app.config['PAYMENT_FAILURE_RATE'] = 0
+    with app_module.app.app_context():
+        app_module.db.drop_all()
+        app_module.db.create_all()
+    _isolated_app = app_module
+    return app_module
+
+def login_as(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+_fixture = None
+
+def seed_fixture(app_module):
+    """Bookings and orders spread over ~500 days in the test schema, plus a paid order for today,
+    so the optimizer has realistic selectivity. Returns ids the tests need; seeds once per run"""
+    global _fixture
+    if _fixture is not None:
+        return _fixture
+    from datetime import datetime, timedelta, timezone
+    from sqlalchemy import insert, text
+    app, db = app_module.app, app_module.db
+    User, Temple, Booking, Order = app_module.User, app_module.Temple, app_module.Booking, app_module.Order
+    
+    with app.app_context():
+        admin = User(name='Fixture Admin', email='fixture-admin@example.com', password_hash='-', role='admin')
+        pilgrims = [User(name=f'Fixture Pilgrim {i}', email=f'fixture-{i}@example.com', password_hash='-')
+                    for i in range(20)]
+        temples = [Temple(name=f'Fixture Temple {i}', location='Test', capacity=100) for i in range(3)]
+        db.session.add_all([admin, *pilgrims, *temples])
+        db.session.commit()
+        
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        bookings = []
+        for i in range(5000):
+            # The last few are created now, for today's visit, and paid
+            created_at = now - timedelta(minutes=(i * 151) % (500 * 24 * 60)) if i >= 5 else now
+            bookings.append({
+                'user_id': pilgrims[i % len(pilgrims)].id,
+                'temple_id': temples[i % len(temples)].id,
+                'date': app_module.local_date(created_at) if i >= 5 else app_module.local_today(),
+                'time_slot': '06:00-08:00',
+                'persons': 1 + i % 4,
+                'confirmation_id': f'FIX{i:08d}',
+                'status': 'confirmed',
+                'payment_status': 'completed' if i % 3 or i < 5 else 'pending',
+                'total_amount': 50.0 * (1 + i % 4),
+                'created_at': created_at,
+            })
+        db.session.execute(insert(Booking), bookings)
+        rows = db.session.query(Booking.id, Booking.created_at).filter(Booking.confirmation_id.like('FIX%')).all()
+        db.session.execute(insert(Order), [
+            {'booking_id': booking_id, 'total_amount': 0.0, 'qr_code': f'FIXQR{booking_id:08d}',
+             'status': 'pending', 'created_at': created_at}
+            for booking_id, created_at in rows
+        ])
+        db.session.commit()
+        app_module.ensure_crowd_rows()
+        for table in ('user', 'temple', 'booking', '`order`'):
+            db.session.execute(text(f'ANALYZE TABLE {table}'))
+        
+        today_order = Order.query.join(Booking).filter(Booking.confirmation_id == 'FIX00000000').one()
+        _fixture = {'admin_id': admin.id, 'today_qr_code': today_order.qr_code}
+    return _fixture
+
+def explain(query):
+    """Run EXPLAIN for a SQLAlchemy query against the configured MySQL database"""
+    from app import db
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    result = db.session.connection().exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params)
+    columns = list(result.keys())
+    return [dict(zip(columns, row)) for row in result.fetchall()]
+
+def test_date_filters_use_indexes():
+    """Day/month filters must stay sargable: on the fixture data EXPLAIN has to pick a created_at index"""
+    app_module = isolated_app()
+    if app_module is None:
+        print("✗ TEST_MYSQL_DB not set - skipping index checks")
+        return
+    seed_fixture(app_module)
+    app, db, Booking, Order = app_module.app, app_module.db, app_module.Booking, app_module.Order
+    local_today, day_bounds, month_bounds = app_module.local_today, app_module.day_bounds, app_module.month_bounds
+    created_within = app_module.created_within
+    
+    with app.app_context():
+        today = local_today()
+        queries = {
+            'bookings today': (
+                Booking.query.filter(created_within(Booking.created_at, day_bounds(today))),
+                {'idx_booking_created'}
+            ),
+            'completed bookings this month': (
+                Booking.query.filter(
+                    created_within(Booking.created_at, day_bounds(today.replace(day=1), today)),
+                    Booking.payment_status == 'completed'
+                ),
+                {'idx_booking_created', 'idx_booking_payment_created'}
+            ),
+            'orders this month': (
+                db.session.query(db.func.sum(Order.total_amount)).filter(
+                    created_within(Order.created_at, month_bounds(today))
+                ),
+                {'idx_order_created'}
+            ),
+        }
+        
+        for name, (query, expected_keys) in queries.items():
+            plan = explain(query)[0]
+            if plan.get('key') in expected_keys:
+                print(f"✓ {name} uses {plan['key']}")
+            else:
+                print(f"✗ {name} does not use a created_at index - plan: {plan}")
+            assert plan.get('key') in expected_keys, name
+
+def test_dashboard_query_budgets():
+    """Admin views must stay within their @query_budget however many bookings exist today"""
+    app_module = isolated_app()
+    if app_module is None:
+        print("✗ TEST_MYSQL_DB not set - skipping query budget checks")
+        return
+    fixture = seed_fixture(app_module)
+    app = app_module.app
+    
+    client = app.test_client()
+    login_as(client, fixture['admin_id'])
+    
+    strict = app.config['QUERY_BUDGET_STRICT']
+    app.config['QUERY_BUDGET_STRICT'] = True
+    try:
+        for page in ['/temple-dashboard', '/admin']:
+            response = client.get(page)
+            print(f"✓ {page} within query budget" if response.status_code == 200 else f"✗ {page} - Status: {response.status_code}")
+            assert response.status_code == 200, page
+        
+        # A paid order for today, the only kind verify-qr admits
+        response = client.post('/api/verify-qr', json={'qr_code': fixture['today_qr_code']})
+        print("✓ /api/verify-qr within query budget" if response.status_code == 200 else f"✗ /api/verify-qr - Status: {response.status_code}")
+        assert response.status_code == 200
+    finally:
+        app.config['QUERY_BUDGET_STRICT'] = strict
+
+def test_payment_is_applied_once():
+    """Paying an already-paid booking must not bump the rollup or queue another confirmation"""
+    app_module = isolated_app()
+    if app_module is None:
+        print("✗ TEST_MYSQL_DB not set - skipping double payment check")
+        return
+    app, db = app_module.app, app_module.db
+    User, Temple, Booking = app_module.User, app_module.Temple, app_module.Booking
+    DailyTempleStats, EmailOutbox = app_module.DailyTempleStats, app_module.EmailOutbox
+    
+    with app.app_context():
+        pilgrim = User(name='Payment Test', email='payment-test@example.com', password_hash='-', role='pilgrim')
+        temple = Temple(name='Payment Test Temple', location='Test', capacity=100)
+        db.session.add_all([pilgrim, temple])
+        db.session.commit()
+        pilgrim_id, temple_id = pilgrim.id, temple.id
+    
+    client = app.test_client()
+    login_as(client, pilgrim_id)
+    response = client.post('/api/book', json={
+        'temple_id': temple_id, 'date': app_module.local_today().isoformat(), 'time_slot': '06:00-08:00',
+        'persons': 2, 'prasads': [], 'poojas': []
+    })
+    assert response.status_code == 200, response.get_data(as_text=True)
+    booking_id = response.get_json()['booking_id']
+    
+    def snapshot():
+        with app.app_context():
+            booking = db.session.get(Booking, booking_id)
+            stats = DailyTempleStats.query.filter_by(day=app_module.local_date(booking.created_at), temple_id=temple_id).first()
+            emails = EmailOutbox.query.filter_by(booking_id=booking_id).count()
+            return (stats.paid_bookings, stats.visitors, stats.revenue) if stats else (0, 0, 0), emails
+    
+    before = snapshot()
+    first = client.post('/api/process-payment', json={'booking_id': booking_id}).get_json()
+    assert first['success'], first
+    after_first = snapshot()
+    assert after_first[0][0] == before[0][0] + 1 and after_first[1] == before[1] + 1, (before, after_first)
+    
+    for _ in range(3):
+        again = client.post('/api/process-payment', json={'booking_id': booking_id}).get_json()
+        assert again['success'] and again['transaction_id'] == first['transaction_id']
+    after_repeat = snapshot()
+    if after_repeat == after_first:
+        print("✓ Repeat payments leave the rollup and the outbox unchanged")
+    else:
+        print(f"✗ Repeat payments changed state: {after_first} -> {after_repeat}")
+    assert after_repeat == after_first
+
 if __name__ == '__main__':
     print("Enhanced Temple Management System Test")
     print("=" * 50)
@@ -69,4 +286,11 @@ if __name__ == '__main__':
     print()
     test_web_pages()
     print()
+    # In-process tests share the TEST_MYSQL_DB schema, set up by whichever runs first
+    test_payment_is_applied_once()
+    print()
+    test_date_filters_use_indexes()
+    print()
+    test_dashboard_query_budgets()
+    print()
     print("Test completed!")
\ No newline at end of file